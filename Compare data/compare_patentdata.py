@@ -1,3 +1,5 @@
+import os
+import sys
 import pandas
 import re
 from rapidfuzz import process, fuzz
@@ -12,29 +14,19 @@ def clean_company_name(name):
     name = re.sub(r'(\b' + r'\b|\b'.join(stopwords) + r'\b)$', ' ', name)
     return name.strip()
 
-import pyodbc
+# This allows us to import modules from the parent directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-server = ''
-database = ''
-username = ''
-password = ''
-driver = ''
+from db_api.database import DatabaseClient
 
-with pyodbc.connect(
-        'DRIVER=' + driver + ';SERVER=tcp:' + server + ';PORT=1433;DATABASE=' + database + ';UID=' + username + ';PWD=' + password) as conn:
-    with conn.cursor() as cursor:
-        cursor.execute("SELECT DISTINCT extracted_name FROM applicants")
-        data = cursor.fetchall()
+db_client = DatabaseClient(env="live")
 
-applicants = [clean_company_name(rows[0]) for rows in data]
+# The names are cleaned as the rows are streamed, so the raw rows are never all in memory
+applicants = [clean_company_name(row[0])
+              for row in db_client.iter_query("SELECT DISTINCT extracted_name FROM applicants")]
 
-with pyodbc.connect(
-        'DRIVER=' + driver + ';SERVER=tcp:' + server + ';PORT=1433;DATABASE=' + database + ';UID=' + username + ';PWD=' + password) as conn:
-    with conn.cursor() as cursor:
-        cursor.execute("SELECT DISTINCT yritys FROM yritykset")
-        data = cursor.fetchall()
-
-companies = [clean_company_name(rows[0]) for rows in data]
+companies = [clean_company_name(row[0])
+             for row in db_client.iter_query("SELECT DISTINCT yritys FROM yritykset")]
 
 print(len(companies))
 
@@ -20,7 +20,8 @@ db_api_path = project_root / "db-api"  # /Dataamo/db-api
 sys.path.insert(0, str(db_api_path))
 
 try:
-    from database import DatabaseClient
+    from database import DatabaseClient, DatabaseError, UPSERT_CHUNK_SIZE
+    import stats as db_stats
 except ImportError as e:
     print("Import failed:", e)
     exit()
@@ -101,23 +102,52 @@ def save_pprint_to_file(data, filename):
   with open(filename, 'w', encoding='utf-8') as f:
     pprint(data, stream=f)
 
-def upsert_records(df, table_name, key_columns):
+def add_stats(db_client, deltas):
+    """Add to the database statistics in a savepoint, so that a missing stats table does not fail the upsert."""
+    try:
+        with db_client.savepoint():
+            db_stats.add(db_client, deltas)
+    except DatabaseError as e:
+        print(f"Could not update the database statistics, rebuild them with ipr/rebuild_stats.py: {e}")
+
+# Number of the hottest SQL statements printed after each upsert, 0 to not record them
+SQL_REPORT_TOP = 0
+
+def upsert_records(df, table_name, key_columns, sql_report=SQL_REPORT_TOP):
     """
     Generic upsert method for all entity types
     
     Args:
         df: DataFrame containing records to upsert
         table_name: Name of the database table
-        key_columns: List of column names that form the unique key
+        key_columns: List of column names that form the unique key. The table should have a
+            unique index on them (see ipr/tables.sql), else the upsert falls back to a slower
+            select-then-update/insert
+        sql_report: Print this many of the hottest SQL statements of the process after the upsert
     """
     with DatabaseClient(env="local") as db_client:
+        if sql_report:
+            db_client.instrument()
         try:
-            for _, row in df.iterrows():
-                # Create data dictionary dynamically from row
-                data = {col: row[col] for col in df.columns if col != 'id'}
-                db_client.upsert(table_name, key_columns, data)
+            # Set-based upserts committed in chunks, missing values are written as NULLs
+            records = df.drop(columns='id', errors='ignore')
+            records = records.astype(object).where(records.notna(), None)
+            rows = records.to_dict('records')
+            if table_name == "patents":
+                for start in range(0, len(rows), UPSERT_CHUNK_SIZE):
+                    # The new patents of a chunk are counted in the same transaction as the chunk
+                    chunk = rows[start:start + UPSERT_CHUNK_SIZE]
+                    lens_ids = {row["lens_id"] for row in chunk}
+                    stored = db_client.select_in(table_name, ["lens_id"], "lens_id", lens_ids)
+                    db_client.upsert_many(table_name, key_columns, chunk, commit=False)
+                    add_stats(db_client, {"patents": len(lens_ids) - len(stored)})
+                    db_client._session.commit()
+            else:
+                db_client.upsert_many(table_name, key_columns, rows)
 
             print(f"Upserted {len(df)} records to {table_name} table")
+            if sql_report:
+                print(db_client.sql_stats.format_report(top=sql_report))
 
         except Exception as e:
             print(f"Failed to upsert to {table_name}: {str(e)}")
@@ -1,42 +1,215 @@
+import io
 import os
+import re
+import time
+import threading
+from contextlib import ExitStack, contextmanager
+from functools import lru_cache
+from itertools import islice
 from urllib.parse import quote_plus
 from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.exc import SQLAlchemyError
 from dotenv import load_dotenv
 
+# Max bind parameters and rows in one multi-row statement, MSSQL allows 2100 parameters
+# and 1000 rows in a VALUES list
+MAX_PARAMS = 2000
+MAX_ROWS = 1000
+
+# Rows written and committed at a time by upsert_many
+UPSERT_CHUNK_SIZE = 5000
+
+# Connection pool of each engine, can be overridden with DB_POOL_SIZE and DB_MAX_OVERFLOW
+DEFAULT_POOL_SIZE = 5
+DEFAULT_MAX_OVERFLOW = 10
+
+# Rows fetched per round trip by the streaming queries
+QUERY_CHUNK_SIZE = 10000
+
+# Rows per COPY or executemany round of bulk_load
+BULK_CHUNK_SIZE = 10000
+
+# Marks the NULL values in the CSV data of COPY, so that empty strings stay empty strings
+COPY_NULL = "\\N"
+
+# Distinct single row statements kept by the statement cache
+STATEMENT_CACHE_SIZE = 512
+
+# Table and column names accepted in the generated SQL, optionally with a schema
+IDENTIFIER_PATTERN = re.compile(r"^[^\W\d]\w*(\.[^\W\d]\w*)?$")
+
+# Pooled connections are replaced after this many seconds, before Azure SQL drops idle ones
+POOL_RECYCLE = 1800
+
+_engines = {}
+_engines_lock = threading.Lock()
+
 class DatabaseError(Exception):
     pass
 
+def get_engine(url, pool_size=DEFAULT_POOL_SIZE, max_overflow=DEFAULT_MAX_OVERFLOW, pool_pre_ping=True):
+    """
+    Return the process-wide engine of a connection URL, creating it on first use.
+
+    All the DatabaseClients of the same database and pool settings share the engine and
+    so its connection pool. With pool_pre_ping, pooled connections are checked before
+    they are handed out, so connections dropped by the server are replaced transparently.
+    """
+    key = (url, pool_size, max_overflow, pool_pre_ping)
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is None:
+            options = {}
+            if url.startswith("mssql+pyodbc"):
+                # Sends executemany parameters in arrays instead of a round trip per row
+                options["fast_executemany"] = True
+            # echo=False to avoid logging all SQL statements
+            engine = create_engine(url, echo=False, pool_size=pool_size, max_overflow=max_overflow,
+                                   pool_pre_ping=pool_pre_ping, pool_recycle=POOL_RECYCLE, **options)
+            _engines[key] = engine
+        return engine
+
+@lru_cache(maxsize=None)
+def _unique_keys(engine, table_name):
+    """
+    Return the column sets of the primary key, unique constraints and unique indexes of a table.
+
+    Read once per engine and table, so keys added later are only seen by a new process.
+    """
+    from sqlalchemy import inspect
+
+    schema, _, name = table_name.rpartition(".")
+    inspector = inspect(engine)
+    keys = set()
+    primary_key = inspector.get_pk_constraint(name, schema=schema or None)["constrained_columns"]
+    if primary_key:
+        keys.add(frozenset(primary_key))
+    for constraint in inspector.get_unique_constraints(name, schema=schema or None):
+        keys.add(frozenset(constraint["column_names"]))
+    for index in inspector.get_indexes(name, schema=schema or None):
+        if index["unique"] and all(index["column_names"]):
+            keys.add(frozenset(index["column_names"]))
+    return keys
+
+def _check_identifier(name):
+    if not isinstance(name, str) or not IDENTIFIER_PATTERN.match(name):
+        raise ValueError(f"Invalid table or column name: {name!r}")
+    return name
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _statement(operation, table_name, columns=(), key_columns=()):
+    """
+    Return the text() statement of a single row insert, update or delete, building it on first use.
+
+    The statements are cached per (operation, table, columns, key columns) and shared by
+    all the clients, so repeated calls skip the string building and bind parameter
+    parsing, and the driver sees identical SQL it can reuse a plan for. The identifiers
+    are validated when a statement is built, the bind parameters are named after the
+    columns.
+    """
+    for name in (table_name,) + tuple(columns) + tuple(key_columns):
+        _check_identifier(name)
+    where = " AND ".join(f"{col} = :{col}" for col in key_columns)
+
+    if operation == "insert":
+        sql = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({', '.join(f':{col}' for col in columns)})"
+    elif operation == "update":
+        assignments = ", ".join(f"{col} = :{col}" for col in columns if col not in key_columns)
+        sql = f"UPDATE {table_name} SET {assignments} WHERE {where}"
+    elif operation == "delete":
+        sql = f"DELETE FROM {table_name} WHERE {where}"
+    else:
+        raise ValueError(f"Unknown operation: {operation}")
+    return text(sql)
+
+def statement_cache_info():
+    """Return the hits, misses, maxsize and currsize of the statement cache."""
+    return _statement.cache_info()
+
+def dispose_engines():
+    """Close the pooled connections of all the engines, e.g. before the process forks."""
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+
 class DatabaseClient:
-    def __init__(self, env="live"):
+    """
+    Database access for one of the environments ('live', 'local' or 'sqlite').
+
+    A `with client as db:` block is a unit of work: all the operations in it run in one
+    session on one pooled connection, and they are committed once when the block exits,
+    or rolled back if it raises. Nested blocks join the outermost one. Outside of a block,
+    insert and delete run and commit on their own. The engines are shared, see get_engine.
+    """
+
+    def __init__(self, env="live", pool_size=None, max_overflow=None, pool_pre_ping=True):
         self.env = env
         self._load_dotenv()
+        self.pool_size = pool_size or int(os.getenv("DB_POOL_SIZE", DEFAULT_POOL_SIZE))
+        self.max_overflow = max_overflow if max_overflow is not None else \
+            int(os.getenv("DB_MAX_OVERFLOW", DEFAULT_MAX_OVERFLOW))
+        self.pool_pre_ping = pool_pre_ping
         self._engine = self._create_engine()
         self._session_factory = scoped_session(sessionmaker(bind=self._engine))
+        self._session = None
+        self._depth = 0
+        # DB_SQL_STATS=<file> instruments the engine and writes the statistics to the file at exit
+        if os.getenv("DB_SQL_STATS"):
+            self.instrument(dump_path=os.getenv("DB_SQL_STATS"))
 
     def __enter__(self):
-        self._session = self._session_factory()
+        # Nested blocks share the session of the outermost block
+        if self._depth == 0:
+            self._session = self._session_factory()
+        self._depth += 1
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        if exc_type:
-            self._session.rollback()
-        else:
-            self._session.commit()
-        self._session.close()
+        self._depth -= 1
+        if self._depth:
+            return
+        try:
+            if exc_type:
+                self._session.rollback()
+            else:
+                self._session.commit()
+        finally:
+            self._session.close()
+            self._session = None
+
+    @contextmanager
+    def savepoint(self):
+        """
+        Run a block in a savepoint of the current unit of work.
+
+        If the block raises, only its changes are rolled back and the exception is
+        re-raised, so the caller can skip e.g. one failed sub-batch and go on.
+        """
+        if self._session is None:
+            raise DatabaseError("A savepoint needs an open unit of work (a with block).")
+        nested = self._session.begin_nested()
+        try:
+            yield self
+        except BaseException:
+            nested.rollback()
+            raise
+        nested.commit()
 
     def _load_dotenv(self):
         if self.env == "local":
             load_dotenv(".env.local")
         elif self.env == "live":
             load_dotenv(".env.live")
+        elif self.env == "sqlite":
+            load_dotenv(".env.sqlite")
         else:
             raise ValueError(f"Invalid environment: {self.env}")
 
     def _create_engine(self):
         """
-        Creates a SQLAlchemy engine based on the environment ('live' or 'local').
+        Creates a SQLAlchemy engine based on the environment ('live', 'local' or 'sqlite').
         Reads connection details from environment variables.
         """
         if self.env == "live":
@@ -67,12 +240,38 @@ class DatabaseClient:
                 raise ValueError("Missing PostgreSQL configuration values.")
 
             connection_string = f"postgresql+psycopg2://{uid}:{passwd}@{server}:{port}/{database}"
-            
+
+        elif self.env == "sqlite":
+            # Embedded SQLite database for benchmarks and testing, the tables have to be created first
+            path = os.getenv("SQLITE_PATH", "dataamo.sqlite")
+            connection_string = f"sqlite:///{path}"
+
         else:
-            raise ValueError(f"Invalid environment: {self.env}. Must be 'live' or 'local'.")
+            raise ValueError(f"Invalid environment: {self.env}. Must be 'live', 'local' or 'sqlite'.")
+
+        # The engine and its connection pool are shared with the other clients of the process
+        return get_engine(connection_string, self.pool_size, self.max_overflow, self.pool_pre_ping)
 
-        # Returns the engine with echo=False to avoid logging all SQL statements.
-        return create_engine(connection_string, echo=False)  
+    def instrument(self, slow_threshold=None, dump_path=None):
+        """
+        Record statistics of the SQL statements run on the engine of this client.
+
+        Returns the SqlStats of the engine, the same one on every call and for every
+        client sharing the engine. The slow statement threshold defaults to
+        DB_SLOW_STATEMENT_SECONDS. See db_api.instrumentation.
+        """
+        from db_api import instrumentation
+
+        if slow_threshold is None:
+            slow_threshold = float(os.getenv("DB_SLOW_STATEMENT_SECONDS", instrumentation.DEFAULT_SLOW_THRESHOLD))
+        return instrumentation.instrument(self._engine, slow_threshold, dump_path)
+
+    @property
+    def sql_stats(self):
+        """The SqlStats of the engine, or None if it is not instrumented."""
+        from db_api import instrumentation
+
+        return instrumentation.get_stats(self._engine)
 
     def query(self, query, params=None):
         try:
@@ -86,6 +285,65 @@ class DatabaseClient:
         except SQLAlchemyError as e:
             raise DatabaseError(f"Error executing query: {e}")
 
+    def iter_query_chunks(self, query, params=None, chunk_size=QUERY_CHUNK_SIZE):
+        """
+        Run a query and yield its rows in lists of at most `chunk_size` rows, as they arrive.
+
+        Postgres reads the rows through a server-side cursor, and MSSQL fetches them in
+        arrays of `chunk_size` rows, so only one chunk is held in memory at a time. The
+        query runs in the unit of work if there is one, otherwise on its own connection
+        that is released when the generator is exhausted or closed.
+        """
+        with ExitStack() as stack:
+            if self._session is not None:
+                connection = self._session.connection()
+            else:
+                connection = stack.enter_context(self._engine.connect())
+            try:
+                # Options of this statement only, Connection.execution_options would change the
+                # session's connection in place and stream the rest of the unit of work too
+                result = stack.enter_context(connection.execute(
+                    text(query), params, execution_options={"stream_results": True, "max_row_buffer": chunk_size}))
+                # pyodbc fetches arraysize rows per round trip
+                if result.cursor is not None:
+                    result.cursor.arraysize = chunk_size
+                for rows in result.partitions(chunk_size):
+                    yield rows
+            except SQLAlchemyError as e:
+                raise DatabaseError(f"Error executing query: {e}")
+
+    def iter_query(self, query, params=None, chunk_size=QUERY_CHUNK_SIZE):
+        """Run a query and yield its rows one by one while they are streamed, see iter_query_chunks."""
+        for rows in self.iter_query_chunks(query, params, chunk_size):
+            yield from rows
+
+    def query_df(self, query, params=None, chunksize=None, dtype_backend=None):
+        """
+        Run a query and return its result as a DataFrame.
+
+        With chunksize, returns a generator of DataFrames of at most `chunksize` rows that
+        are built as the rows are streamed, so any number of rows can be processed in
+        constant memory. With dtype_backend="pyarrow", the columns are Arrow backed.
+        """
+        import pandas as pd
+
+        def to_df(rows, columns):
+            df = pd.DataFrame.from_records(rows, columns=columns)
+            return df.convert_dtypes(dtype_backend=dtype_backend) if dtype_backend else df
+
+        def frames():
+            chunks = self.iter_query_chunks(query, params, chunksize or QUERY_CHUNK_SIZE)
+            for rows in chunks:
+                yield to_df(rows, list(rows[0]._fields))
+
+        if chunksize:
+            return frames()
+        try:
+            result = self._session.execute(text(query), params)
+        except SQLAlchemyError as e:
+            raise DatabaseError(f"Error executing query: {e}")
+        return to_df(result.fetchall(), list(result.keys()))
+
     def upsert(self, table_name, key_column, data):
         """
         Perform an upsert operation.
@@ -93,60 +351,341 @@ class DatabaseClient:
         :param table_name: Name of the table.
         :param key_column: The unique key column to check for existing records.
         :param data: Dictionary of column-value pairs to upsert. Must include the key column.
+
+        Runs in the unit of work and is committed with it, use upsert_many for many rows.
         """
         if key_column not in data:
             raise ValueError(f"Key column '{key_column}' must be in the data dictionary.")
 
-        columns = list(data.keys())
-        placeholders = ', '.join([f":{col}" for col in columns])
-        update_columns = ', '.join([f"{col} = :{col}" for col in columns if col != key_column])
-        
-        update_sql = f"UPDATE {table_name} SET {update_columns} WHERE {key_column} = :{key_column}"
-        insert_sql = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({placeholders})"
-        
+        columns = tuple(data.keys())
+        update_statement = _statement("update", table_name, columns, (key_column,))
+        insert_statement = _statement("insert", table_name, columns)
+
         try:
             # Execute update
-            update_result = self._session.execute(text(update_sql), data)
+            update_result = self._session.execute(update_statement, data)
             
             # Check if any row was updated
             if update_result.rowcount == 0:
                 # If no rows were updated, insert a new row
-                self._session.execute(text(insert_sql), data)
-            
-            self._session.commit()
-        
+                self._session.execute(insert_statement, data)
         except SQLAlchemyError as e:
-            self._session.rollback()
             raise DatabaseError(f"Error upserting into {table_name}: {e}")
 
     def insert_dataframe_to_table(self, df, table_name):
+        """Append a DataFrame to a table with the fastest method of the back end, see bulk_load."""
+        return self.bulk_load(df, table_name)
+
+    def bulk_load(self, frames, table_name, chunk_size=BULK_CHUNK_SIZE):
+        """
+        Append a DataFrame, or an iterable of DataFrames such as a chunked read_csv, to a table.
+
+        Postgres streams the rows with COPY FROM STDIN, one CSV chunk at a time. MSSQL
+        inserts them in chunks with pyodbc's fast_executemany, which the engine enables.
+        Other back ends, and Postgres drivers without COPY support, use DataFrame.to_sql.
+        The table must exist. For COPY, integer columns with missing values need the
+        nullable Int64 dtype, as floats are written with decimals. The load runs in the
+        unit of work if there is one, otherwise in its own transaction.
+
+        Returns a dict with the method used, the rows, the seconds and the rows per second.
+        """
+        import pandas as pd
+
+        if isinstance(frames, pd.DataFrame):
+            frames = [frames]
+        method = "copy" if self._dialect() == "postgresql" else "executemany" if self._dialect() == "mssql" \
+            else "to_sql"
+        rows = 0
+        started = time.perf_counter()
         try:
-            df.to_sql(table_name, self._engine, if_exists='append', index=False)
-            self._session.commit()
-        except SQLAlchemyError as e:
-            self._session.rollback()
-            raise DatabaseError(f"Error inserting dataframe: {e}")
+            with self as db:
+                connection = db._session.connection()
+                if method == "copy" and self._engine.dialect.driver != "psycopg2":
+                    method = "to_sql"
+                for df in frames:
+                    for i in range(0, len(df), chunk_size):
+                        chunk = df.iloc[i:i + chunk_size]
+                        if method == "copy":
+                            self._copy_chunk(connection, chunk, table_name)
+                        else:
+                            chunk.to_sql(table_name, connection, if_exists='append', index=False)
+                        rows += len(chunk)
+        except (SQLAlchemyError, self._dbapi_error()) as e:
+            raise DatabaseError(f"Error loading into {table_name} after {rows} rows: {e}")
+
+        seconds = time.perf_counter() - started
+        return {"method": method, "rows": rows, "seconds": round(seconds, 3),
+                "rows_per_second": round(rows / seconds, 1) if seconds else None}
+
+    def _dbapi_error(self):
+        return self._engine.dialect.loaded_dbapi.Error
+
+    @staticmethod
+    def _copy_chunk(connection, df, table_name):
+        """Write one DataFrame chunk with COPY FROM STDIN, in the transaction of `connection`."""
+        buffer = io.StringIO()
+        df.to_csv(buffer, index=False, header=False, na_rep=COPY_NULL)
+        buffer.seek(0)
+        columns = ", ".join(df.columns)
+        with connection.connection.cursor() as cursor:
+            cursor.copy_expert(f"COPY {table_name} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '{COPY_NULL}')",
+                               buffer)
 
     def delete(self, table_name, key_column, key_value):
-        """Deletes records from a table based on a key column and value."""
+        """
+        Deletes records from a table based on a key column and value.
+
+        In a with block it runs in the unit of work, otherwise on its own connection.
+        """
+        statement = _statement("delete", table_name, (), (key_column,))
+        if self._session is not None:
+            try:
+                self._session.execute(statement, {key_column: key_value})
+            except SQLAlchemyError as e:
+                raise RuntimeError(f"Error deleting from {table_name}: {e}")
+            return
+
         with self._engine.connect() as connection:
             try:
-                sql = f"DELETE FROM {table_name} WHERE {key_column} = :key_value"
-                connection.execute(text(sql), {"key_value": key_value})
+                connection.execute(statement, {key_column: key_value})
                 connection.commit()
             except Exception as e:
                 connection.rollback()
                 raise RuntimeError(f"Error deleting from {table_name}: {e}")
 
     def insert(self, table_name, data):
-        """Inserts a single record into a table."""
+        """
+        Inserts a single record into a table.
+
+        In a with block it runs in the unit of work, otherwise on its own connection.
+        """
+        statement = _statement("insert", table_name, tuple(data.keys()))
+        if self._session is not None:
+            try:
+                self._session.execute(statement, data)
+            except SQLAlchemyError as e:
+                raise RuntimeError(f"Error inserting into {table_name}: {e}")
+            return
+
         with self._engine.connect() as connection:
             try:
-                columns = ", ".join(data.keys())
-                placeholders = ", ".join([f":{key}" for key in data.keys()])
-                sql = f"INSERT INTO {table_name} ({columns}) VALUES ({placeholders})"
-                connection.execute(text(sql), data)
+                connection.execute(statement, data)
                 connection.commit()
             except Exception as e:
                 connection.rollback()
                 raise RuntimeError(f"Error inserting into {table_name}: {e}")
+
+    def _dialect(self):
+        return self._engine.dialect.name
+
+    @staticmethod
+    def _row_chunks(n_rows, n_columns):
+        """Yield (start, stop) row ranges that keep one multi-row statement under the parameter limits."""
+        size = max(1, min(MAX_ROWS, MAX_PARAMS // max(1, n_columns)))
+        for start in range(0, n_rows, size):
+            yield start, min(start + size, n_rows)
+
+    @staticmethod
+    def _to_columns(rows):
+        """Turn rows (dicts with the same keys) into a {column: list of values} dict."""
+        return {col: [row.get(col) for row in rows] for col in rows[0].keys()}
+
+    def _execute_multirow(self, sql_prefix, data, sql_suffix=""):
+        """
+        Execute `sql_prefix VALUES (...), (...) sql_suffix` in chunks, within the session.
+
+        `data` is a {column: list of values} dict, the parameters are bound from the columns.
+        """
+        columns = list(data)
+        n_rows = len(data[columns[0]]) if columns else 0
+        for start, stop in self._row_chunks(n_rows, len(columns)):
+            params = {}
+            for col in columns:
+                values = data[col]
+                params.update({f"{col}_{i}": values[start + i] for i in range(stop - start)})
+            values = ", ".join("(" + ", ".join(f":{col}_{i}" for col in columns) + ")" for i in range(stop - start))
+            self._session.execute(text(f"{sql_prefix} VALUES {values} {sql_suffix}"), params)
+
+    def insert_many(self, table_name, rows):
+        """
+        Insert many rows (dicts with the same keys) with multi-row INSERT statements.
+
+        Runs in the current session and does not commit.
+        """
+        if rows:
+            self.insert_columns(table_name, self._to_columns(rows))
+
+    def insert_columns(self, table_name, data):
+        """Like insert_many, with the rows given as a {column: list of values} dict."""
+        try:
+            self._execute_multirow(f"INSERT INTO {table_name} ({', '.join(data)})", data)
+        except SQLAlchemyError as e:
+            raise DatabaseError(f"Error inserting into {table_name}: {e}")
+
+    def delete_many(self, table_name, key_column, key_values):
+        """
+        Delete the rows whose key column is one of `key_values`, return the number deleted.
+
+        Runs in the current session and does not commit.
+        """
+        key_values = list(key_values)
+        deleted = 0
+        try:
+            for i in range(0, len(key_values), MAX_PARAMS):
+                chunk = key_values[i:i + MAX_PARAMS]
+                params = {f"k{j}": value for j, value in enumerate(chunk)}
+                placeholders = ", ".join(f":{key}" for key in params)
+                sql = f"DELETE FROM {table_name} WHERE {key_column} IN ({placeholders})"
+                deleted += self._session.execute(text(sql), params).rowcount
+        except SQLAlchemyError as e:
+            raise DatabaseError(f"Error deleting from {table_name}: {e}")
+        return deleted
+
+    def select_in(self, table_name, columns, key_column, key_values):
+        """Return the `columns` of the rows whose key column is one of `key_values`."""
+        key_values = list(key_values)
+        rows = []
+        try:
+            for i in range(0, len(key_values), MAX_PARAMS):
+                chunk = key_values[i:i + MAX_PARAMS]
+                params = {f"k{j}": value for j, value in enumerate(chunk)}
+                placeholders = ", ".join(f":{key}" for key in params)
+                sql = f"SELECT {', '.join(columns)} FROM {table_name} WHERE {key_column} IN ({placeholders})"
+                rows += self._session.execute(text(sql), params).fetchall()
+        except SQLAlchemyError as e:
+            raise DatabaseError(f"Error selecting from {table_name}: {e}")
+        return rows
+
+    def update_many(self, table_name, data, key_column, key_values):
+        """
+        Set the same column values on all rows whose key column is one of `key_values`.
+
+        Runs in the current session and does not commit.
+        """
+        key_values = list(key_values)
+        assignments = ", ".join(f"{col} = :{col}" for col in data)
+        try:
+            for i in range(0, len(key_values), MAX_PARAMS - len(data)):
+                chunk = key_values[i:i + MAX_PARAMS - len(data)]
+                params = {f"k{j}": value for j, value in enumerate(chunk)}
+                placeholders = ", ".join(f":{key}" for key in params)
+                sql = f"UPDATE {table_name} SET {assignments} WHERE {key_column} IN ({placeholders})"
+                self._session.execute(text(sql), {**params, **data})
+        except SQLAlchemyError as e:
+            raise DatabaseError(f"Error updating {table_name}: {e}")
+
+    def _bulk_upsert(self, table_name, key_columns, rows):
+        """
+        Upsert many rows with set-based SQL, within the session and without committing.
+
+        MSSQL loads the rows into a temporary staging table and MERGEs it into the target,
+        Postgres (and SQLite) use multi-row INSERT ... ON CONFLICT DO UPDATE, which needs a
+        primary key, unique constraint or unique index on exactly the key columns. Without
+        one, the keys already in the table are selected and their rows updated, and the
+        rest are inserted, which is slower and not safe against concurrent writers.
+        `key_columns` is one column name or a list of them. If the same key is in `rows`
+        more than once, the last row wins.
+        """
+        if rows:
+            self._bulk_upsert_columns(table_name, key_columns, self._to_columns(rows))
+
+    def _bulk_upsert_columns(self, table_name, key_columns, data):
+        """Like _bulk_upsert, with the rows given as a {column: list of values} dict."""
+        if isinstance(key_columns, str):
+            key_columns = [key_columns]
+        columns = list(data)
+        missing = [col for col in key_columns if col not in columns]
+        if missing:
+            raise ValueError(f"Key columns {missing} must be in the rows.")
+        n_rows = len(data[columns[0]])
+        if not n_rows:
+            return
+        # The last row of a repeated key wins
+        last = {key: i for i, key in enumerate(zip(*(data[col] for col in key_columns)))}
+        if len(last) < n_rows:
+            keep = sorted(last.values())
+            data = {col: [values[i] for i in keep] for col, values in data.items()}
+        update_columns = [col for col in columns if col not in key_columns]
+
+        try:
+            if self._dialect() == "mssql":
+                stage = f"#stage_{table_name}"
+                self._session.execute(text(f"IF OBJECT_ID('tempdb..{stage}') IS NOT NULL DROP TABLE {stage}"))
+                self._session.execute(text(f"SELECT TOP 0 {', '.join(columns)} INTO {stage} FROM {table_name}"))
+                self._execute_multirow(f"INSERT INTO {stage} ({', '.join(columns)})", data)
+                matched = ""
+                if update_columns:
+                    matched = f"WHEN MATCHED THEN UPDATE SET {', '.join(f't.{col} = s.{col}' for col in update_columns)} "
+                self._session.execute(text(
+                    f"MERGE {table_name} WITH (HOLDLOCK) AS t USING {stage} AS s "
+                    f"ON {' AND '.join(f't.{col} = s.{col}' for col in key_columns)} "
+                    f"{matched}"
+                    f"WHEN NOT MATCHED THEN INSERT ({', '.join(columns)}) "
+                    f"VALUES ({', '.join(f's.{col}' for col in columns)});"))
+                self._session.execute(text(f"DROP TABLE {stage}"))
+            elif not self._has_unique_key(table_name, key_columns):
+                self._upsert_by_select(table_name, key_columns, data, update_columns)
+            else:
+                keys = ", ".join(key_columns)
+                if update_columns:
+                    updates = ", ".join(f"{col} = EXCLUDED.{col}" for col in update_columns)
+                    conflict = f"ON CONFLICT ({keys}) DO UPDATE SET {updates}"
+                else:
+                    conflict = f"ON CONFLICT ({keys}) DO NOTHING"
+                self._execute_multirow(f"INSERT INTO {table_name} ({', '.join(columns)})", data, conflict)
+        except SQLAlchemyError as e:
+            raise DatabaseError(f"Error upserting into {table_name}: {e}")
+
+    def _has_unique_key(self, table_name, key_columns):
+        """Tell if the table has a primary key, unique constraint or unique index on exactly the key columns."""
+        return frozenset(key_columns) in _unique_keys(self._engine, table_name)
+
+    def _upsert_by_select(self, table_name, key_columns, data, update_columns):
+        """Upsert the rows of a {column: list of values} dict into a table without a unique key on the key columns."""
+        rows = list(zip(*data.values()))
+        columns = list(data)
+        key_index = [columns.index(col) for col in key_columns]
+        keys = [tuple(row[i] for i in key_index) for row in rows]
+
+        # Candidates are selected by the first key column and matched on all of them here
+        stored = self.select_in(table_name, key_columns, key_columns[0], {key[0] for key in keys})
+        stored = {tuple(row) for row in stored}
+
+        updates = [row for row, key in zip(rows, keys) if key in stored]
+        if updates and update_columns:
+            assignments = ", ".join(f"{col} = :{col}" for col in update_columns)
+            conditions = " AND ".join(f"{col} = :{col}" for col in key_columns)
+            self._session.execute(text(f"UPDATE {table_name} SET {assignments} WHERE {conditions}"),
+                                  [dict(zip(columns, row)) for row in updates])
+        inserts = [row for row, key in zip(rows, keys) if key not in stored]
+        if inserts:
+            self.insert_columns(table_name, {col: [row[i] for row in inserts] for i, col in enumerate(columns)})
+
+    def upsert_many(self, table_name, key_columns, rows, chunk_size=UPSERT_CHUNK_SIZE, commit=True):
+        """
+        Upsert many rows (dicts with the same keys) with set-based SQL, see _bulk_upsert.
+
+        The rows are written in chunks of `chunk_size` rows and the session is committed
+        after each chunk, so a failure only rolls back the chunk being written. Without
+        commit, the chunks are left to the unit of work and a failure rolls back only
+        the failed chunk, to a savepoint. `rows` can be any iterable, e.g. a generator.
+        Returns the number of rows written.
+        """
+        iterator = iter(rows)
+        written = 0
+        while True:
+            chunk = list(islice(iterator, chunk_size))
+            if not chunk:
+                return written
+            try:
+                if commit:
+                    self._bulk_upsert(table_name, key_columns, chunk)
+                    self._session.commit()
+                else:
+                    with self.savepoint():
+                        self._bulk_upsert(table_name, key_columns, chunk)
+            except (DatabaseError, SQLAlchemyError) as e:
+                if commit:
+                    self._session.rollback()
+                raise DatabaseError(f"Error upserting into {table_name} after {written} rows: {e}")
+            written += len(chunk)
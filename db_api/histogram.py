@@ -0,0 +1,48 @@
+"""
+Fixed-bucket latency histogram, shared by ytj_api.metrics and db_api.instrumentation.
+"""
+from bisect import bisect_left
+
+class Histogram:
+    """Latency histogram with fixed buckets, plus the exact count, sum, min and max."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, p):
+        """Return the upper bound of the bucket holding the p-th percentile, at most the max."""
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+        return self.max
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "seconds": round(self.total, 3),
+            "mean": round(self.total / self.count, 4) if self.count else None,
+            "min": self.min,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "buckets": dict([(f"<={bound}", count) for bound, count in zip(self.buckets, self.counts)]
+                            + [("inf", self.counts[-1])]),
+        }
@@ -0,0 +1,171 @@
+"""
+Opt-in SQL instrumentation for the DatabaseClient engines.
+
+instrument(engine) hooks SQLAlchemy's cursor execution events and records, for each
+statement shape, the number of executions, a latency histogram and the rows affected.
+Statements slower than a threshold are also kept in a slow statement log. The shape of a
+statement is its SQL with the bind parameters replaced by ? and repeated lists such as
+IN (...) and multi-row VALUES collapsed, so the chunks of a bulk insert count as one.
+
+    stats = DatabaseClient(env="live").instrument()
+    ...
+    print(stats.format_report(top=10))
+
+The engines are shared by the clients of a process, so the statistics cover every
+client of the same database.
+"""
+import re
+import json
+import time
+import atexit
+import threading
+from collections import deque
+from functools import lru_cache
+
+from db_api.histogram import Histogram
+
+# Upper bounds of the statement latency buckets (seconds), finer than the SOAP call ones
+SQL_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Statements taking longer than this are kept in the slow statement log (seconds)
+DEFAULT_SLOW_THRESHOLD = 1.0
+
+# Slow statements kept, the oldest are dropped first
+SLOW_LOG_SIZE = 200
+
+# Characters of a statement kept in the reports
+MAX_STATEMENT_LENGTH = 500
+
+_PLACEHOLDER = re.compile(r"%\(\w+\)s|%s|\?|(?<![:\w]):\w+")
+_PLACEHOLDER_LIST = re.compile(r"\?(\s*,\s*\?)+")
+_ROW_LIST = re.compile(r"\(\?\.\.\.\)(\s*,\s*\(\?\.\.\.\))+|\(\?\)(\s*,\s*\(\?\))+")
+_WHITESPACE = re.compile(r"\s+")
+
+_lock = threading.Lock()
+_instrumented = {}
+
+@lru_cache(maxsize=2048)
+def statement_shape(statement):
+    """Return the normalized shape of a SQL statement, see the module docstring."""
+    shape = _WHITESPACE.sub(" ", statement).strip()
+    shape = _PLACEHOLDER.sub("?", shape)
+    shape = _PLACEHOLDER_LIST.sub("?...", shape)
+    shape = _ROW_LIST.sub(lambda m: m.group(0).split(")")[0] + ")...", shape)
+    return shape[:MAX_STATEMENT_LENGTH]
+
+class StatementStats:
+    """Counts, latency and rows of one statement shape."""
+
+    def __init__(self, shape):
+        self.shape = shape
+        self.latency = Histogram(SQL_LATENCY_BUCKETS)
+        self.rows = 0
+        self.executemany = 0
+
+    def as_dict(self):
+        latency = self.latency.as_dict()
+        del latency["buckets"]
+        return dict({"statement": self.shape}, **latency, rows=self.rows, executemany=self.executemany)
+
+class SqlStats:
+    """Per statement shape statistics and the slow statement log of one engine."""
+
+    def __init__(self, slow_threshold=DEFAULT_SLOW_THRESHOLD):
+        self.slow_threshold = slow_threshold
+        self.started = time.time()
+        self.statements = {}
+        self.slow = deque(maxlen=SLOW_LOG_SIZE)
+        self._lock = threading.Lock()
+        self._engine = None
+
+    def attach(self, engine):
+        from sqlalchemy import event
+
+        event.listen(engine, "before_cursor_execute", self._before)
+        event.listen(engine, "after_cursor_execute", self._after)
+        self._engine = engine
+        return self
+
+    def detach(self):
+        from sqlalchemy import event
+
+        if self._engine is not None:
+            event.remove(self._engine, "before_cursor_execute", self._before)
+            event.remove(self._engine, "after_cursor_execute", self._after)
+            self._engine = None
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._sql_started = time.perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "_sql_started", None)
+        if started is None:
+            return
+        self.record(statement, time.perf_counter() - started, cursor.rowcount, executemany)
+
+    def record(self, statement, seconds, rowcount=-1, executemany=False):
+        shape = statement_shape(statement)
+        with self._lock:
+            stats = self.statements.get(shape)
+            if stats is None:
+                stats = self.statements[shape] = StatementStats(shape)
+            stats.latency.observe(seconds)
+            if rowcount is not None and rowcount > 0:
+                stats.rows += rowcount
+            if executemany:
+                stats.executemany += 1
+            if seconds >= self.slow_threshold:
+                self.slow.append({"time": time.time(), "seconds": round(seconds, 4),
+                                  "statement": shape})
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.statements.clear()
+            self.slow.clear()
+
+    def report(self, top=10, order_by="seconds"):
+        """Return the `top` statement shapes by total seconds (or count or rows) as dicts."""
+        with self._lock:
+            rows = [stats.as_dict() for stats in self.statements.values()]
+        rows.sort(key=lambda row: row[order_by], reverse=True)
+        return rows[:top] if top else rows
+
+    def format_report(self, top=10, order_by="seconds"):
+        """Return the report as text, one line per statement shape."""
+        rows = self.report(top, order_by)
+        lines = [f"{'count':>8} {'seconds':>9} {'p95':>7} {'rows':>9}  statement"]
+        for row in rows:
+            p95 = f"{row['p95']:.3f}" if row["p95"] is not None else "-"
+            lines.append(f"{row['count']:8} {row['seconds']:9.3f} {p95:>7} {row['rows']:9}  "
+                         f"{row['statement'][:120]}")
+        if self.slow:
+            lines.append(f"{len(self.slow)} statements slower than {self.slow_threshold} s in the slow log")
+        return "\n".join(lines)
+
+    def save(self, path):
+        """Write all the statement statistics and the slow log to a JSON file."""
+        with self._lock:
+            slow = list(self.slow)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"started": self.started, "saved": time.time(), "slow_threshold": self.slow_threshold,
+                       "statements": self.report(top=None), "slow": slow}, f, indent=2)
+
+def instrument(engine, slow_threshold=DEFAULT_SLOW_THRESHOLD, dump_path=None):
+    """
+    Return the SqlStats of an engine, attaching one on the first call.
+
+    With dump_path, the statistics are written to that JSON file when the process exits.
+    """
+    with _lock:
+        stats = _instrumented.get(engine)
+        if stats is None:
+            stats = _instrumented[engine] = SqlStats(slow_threshold).attach(engine)
+            if dump_path:
+                atexit.register(stats.save, dump_path)
+        return stats
+
+def get_stats(engine):
+    """Return the SqlStats of an engine, or None if it is not instrumented."""
+    return _instrumented.get(engine)
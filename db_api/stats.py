@@ -0,0 +1,130 @@
+"""
+Incrementally maintained database statistics for the IPR Suomi sidebar.
+
+The ipr_suomi_stats table holds one row per statistic: a count in `value` or a text in
+`text_value`, with the label shown to users in `indicator`. The loaders update the rows
+in the same transaction as the data they store, with add() for counts and set_max() for
+values such as the last fetched business id, so reading the statistics never scans the
+big tables. rebuild() recomputes everything from scratch, e.g. after the table has been
+created or after manual changes to the data.
+"""
+from datetime import datetime
+# sqlalchemy is imported by the functions that need it, this module is imported by ytj_api.ytj
+
+STATS_TABLE = "ipr_suomi_stats"
+
+# Labels of the statistics, in Finnish like the rest of the sidebar
+LABELS = {
+    "companies": "Yrityksiä tietokannassa",
+    "trade_names": "Aputoiminimiä",
+    "secondary_names": "Rinnakkaistoiminimiä",
+    "previous_names": "Aiempia nimiä",
+    "patents": "Patentteja",
+    "last_bid": "Viimeisin haettu Y-tunnus",
+    "latest_registration_date": "Viimeisin yrityksen rekisteröimispäivä",
+}
+
+# Prefix of the per status company counts, e.g. "status:Elinkeinotoiminta jatkuu"
+STATUS_PREFIX = "status:"
+
+# Business ids from this on are not sequential company ids, as in YtjClient.get_latest_bid
+LAST_BID_LIMIT = "9000000-0"
+
+def status_key(status):
+    return f"{STATUS_PREFIX}{status or '-'}"
+
+def label(key):
+    if key.startswith(STATUS_PREFIX):
+        return f"Yrityksiä, {key[len(STATUS_PREFIX):]}"
+    return LABELS.get(key, key)
+
+def _now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+def _upsert(db, params, column, value, update, condition=None):
+    """
+    Insert a statistics row with `column` set to `value`, or run `update` on the existing row.
+
+    One atomic statement, so concurrent loaders adding the same new key cannot both insert
+    it: MERGE WITH (HOLDLOCK) on MSSQL and INSERT ... ON CONFLICT elsewhere. In `update`
+    and `condition`, `t` is the stored row and `:`-parameters are bound from `params`.
+    """
+    if db._dialect() == "mssql":
+        when = f"WHEN MATCHED AND ({condition}) " if condition else "WHEN MATCHED "
+        sql = (f"MERGE {STATS_TABLE} WITH (HOLDLOCK) AS t USING (SELECT :key AS stat_key) AS s "
+               f"ON t.stat_key = s.stat_key "
+               f"{when}THEN UPDATE SET {update} "
+               f"WHEN NOT MATCHED THEN INSERT (stat_key, indicator, {column}, updated) "
+               f"VALUES (:key, :indicator, {value}, :updated);")
+    else:
+        where = f" WHERE {condition}" if condition else ""
+        sql = (f"INSERT INTO {STATS_TABLE} AS t (stat_key, indicator, {column}, updated) "
+               f"VALUES (:key, :indicator, {value}, :updated) "
+               f"ON CONFLICT (stat_key) DO UPDATE SET {update}{where}")
+    db.query(sql, params)
+
+def add(db, deltas):
+    """
+    Add the {key: delta} counts to the statistics, creating missing rows.
+
+    Runs in the session of `db` and does not commit, so the counts are committed together
+    with the rows they count. The rows are upserted in key order, so that concurrent loaders
+    lock them in the same order and cannot deadlock each other.
+    """
+    now = _now()
+    for key, delta in sorted(deltas.items()):
+        if not delta:
+            continue
+        _upsert(db, {"key": key, "indicator": label(key), "delta": delta, "updated": now},
+                "value", ":delta", "value = t.value + :delta, updated = :updated")
+
+def set_max(db, values):
+    """Raise the {key: text} statistics to the given values if they are larger. Does not commit."""
+    now = _now()
+    for key, value in sorted(values.items()):
+        if value is None:
+            continue
+        _upsert(db, {"key": key, "indicator": label(key), "value": str(value), "updated": now},
+                "text_value", ":value", "text_value = :value, updated = :updated",
+                condition="t.text_value IS NULL OR t.text_value < :value")
+
+def rebuild(db):
+    """Recompute all the statistics with full table scans and replace the stored ones. Commits."""
+    from sqlalchemy import inspect
+
+    counts = {"companies": db.query("SELECT COUNT(*) FROM companies")[0][0]}
+    for status, count in db.query("SELECT status, COUNT(*) FROM companies GROUP BY status"):
+        counts[status_key(status)] = count
+    for table in ("trade_names", "secondary_names", "previous_names"):
+        counts[table] = db.query(f"SELECT COUNT(*) FROM {table}")[0][0]
+    # The patents are only loaded to some of the databases
+    if inspect(db._engine).has_table("patents"):
+        counts["patents"] = db.query("SELECT COUNT(*) FROM patents")[0][0]
+
+    texts = {
+        "last_bid": db.query("SELECT MAX(business_id) FROM companies WHERE business_id < :limit",
+                             {"limit": LAST_BID_LIMIT})[0][0],
+        "latest_registration_date": db.query("SELECT MAX(company_registration_date) FROM companies")[0][0],
+    }
+
+    db.query(f"DELETE FROM {STATS_TABLE}")
+    now = _now()
+    for key, count in counts.items():
+        db.query(f"INSERT INTO {STATS_TABLE} (stat_key, indicator, value, updated) "
+                 f"VALUES (:key, :indicator, :value, :updated)",
+                 {"key": key, "indicator": label(key), "value": count, "updated": now})
+    for key, value in texts.items():
+        if value is not None:
+            db.query(f"INSERT INTO {STATS_TABLE} (stat_key, indicator, text_value, updated) "
+                     f"VALUES (:key, :indicator, :value, :updated)",
+                     {"key": key, "indicator": label(key), "value": str(value), "updated": now})
+    db._session.commit()
+    return dict(counts, **texts)
+
+def read(db_client):
+    """Return the statistics as (indicator, value) rows, from the ipr_suomi_dbinfo view."""
+    from sqlalchemy import text
+
+    # A plain connection instead of the client's session, so that it can be shared between threads
+    with db_client._engine.connect() as connection:
+        return [tuple(row) for row in connection.execute(text("SELECT indicator, value FROM ipr_suomi_dbinfo"))]
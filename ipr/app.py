@@ -1,6 +1,7 @@
 import os
 import sys
 import json
+import pandas as pd
 import streamlit as st
 from streamlit_pills import pills
 
@@ -9,34 +10,112 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 # db_api and ytj_api are folders in the parent directory
 from db_api.database import DatabaseClient
-from ytj_api.ytj import YtjClient
+from db_api import stats as db_stats
+from ytj_api.ytj import YtjClient, SQL_REPORT_TOP
+from ytj_api.cache import ResponseCache
+from ytj_api.bidindex import BidIndex
+from ytj_api.scheduler import RecheckScheduler
+from ytj_api import jobs
+from ytj_api.jobs import JobRunner
 
 _ENV = "live"  # "live" or "local", changes the database connection
 
+# Seconds the sidebar statistics are cached for
+STATS_TTL = 30
+
 # Initialize session state
 if 'raw_data' not in st.session_state:
     st.session_state.raw_data = ""
 
-def fetch_data(progbar, get_records, get_bids, get_bids_fromfile, start_from=None):
+@st.cache_resource
+def get_db_client():
+    # One client, and so one engine and connection pool, for the reads of all the reruns
+    return DatabaseClient(env=_ENV)
+
+@st.cache_data(ttl=STATS_TTL)
+def load_db_info():
+    """The sidebar statistics, maintained by the loaders and cached for STATS_TTL seconds."""
+    return pd.DataFrame(db_stats.read(get_db_client()), columns=["indicator", "value"])
+
+@st.cache_resource
+def get_job_runner():
+    # One runner per server process, its jobs keep running across reruns and page reloads
+    return JobRunner(env=_ENV, cache=ResponseCache())
+
+def submit_job(get_records, get_bids, get_bids_fromfile, start_from=None, skip_unchanged_names=False,
+               use_cache=False, fast_parse=False, recheck_budget=None, resume=False, skip_stored=False):
+    """Collect the business ids of the selected input and queue a background job for them."""
+    runner = get_job_runner()
+    if resume:
+        job_id = runner.last_resumable()
+        if job_id is None:
+            st.info("No interrupted job to resume")
+        else:
+            runner.resume(job_id)
+            st.success(f"Resuming job {job_id}")
+        return
+
+    options = {"skip_unchanged_names": skip_unchanged_names, "use_cache": use_cache, "fast_parse": fast_parse}
+    bid_index = None
     with DatabaseClient(env=_ENV) as db_client:
         ytj_client = YtjClient()
         ytj_client.set_database(db_client)
 
         if get_bids_fromfile is not None:
-            bids = ytj_client.load_bids_from_string(get_bids_fromfile.read().decode('utf-8'))
+            # The upload is read in chunks, not decoded to one string
+            bids = ytj_client.load_bids_from_file(get_bids_fromfile, skip_stored)
+            description = f"File {get_bids_fromfile.name}"
         elif get_bids is not None:
-            bids = ytj_client.load_bids_from_string(get_bids)
+            bids = ytj_client.load_bids_from_string(get_bids, skip_stored)
+            description = "List of business ids"
+        elif recheck_budget is not None:
+            bids, calls = RecheckScheduler(db_client).plan(recheck_budget)
+            st.info(f"Re-checking {len(bids)} companies with about {calls} API calls")
+            description = f"Re-check, budget {recheck_budget}"
         else:
             if not start_from:
                 latest_bid = ytj_client.get_latest_bid()
                 start_from = int(str(latest_bid[:7])) + 1
+            # Skip the ids already stored, known to be empty or checked recently
+            bid_index = BidIndex.load_or_build(db_client)
+            ytj_client.set_bid_index(bid_index)
             bids = ytj_client.generate_bids(start_from, get_records)
-
-        companies = ytj_client.get_multiple(bids, progbar)
-
-        columns = ['business_id', 'company', 'company_form', 'main_industry', 'postal_code', 'company_registration_date', 'status', 'hq', 'checked']
-
-        ytj_client.store_companies_to_db(companies, columns, progbar)
+            description = f"{get_records} new records from {start_from}"
+
+    if not bids:
+        st.info("No business ids to fetch")
+        return
+    job_id = runner.submit(bids, description, bid_index=bid_index, **options)
+    st.success(f"Job {job_id} queued: {description}, {len(bids)} business ids")
+
+@st.fragment(run_every=2)
+def show_jobs():
+    """Progress of the recent jobs, refreshed every few seconds without rerunning the page."""
+    runner = get_job_runner()
+    for job in runner.jobs(limit=10):
+        done = job["bids"] / job["total"] if job["total"] else 1.0
+        st.progress(min(done, 1.0), f"Job {job['job_id']} ({job['state']}): {job['description']} - "
+                                    f"{job['bids']} of {job['total']} ids, {job['companies']} companies")
+        if job["state"] in (jobs.QUEUED, jobs.RUNNING):
+            if st.button("Cancel", key=f"cancel-{job['job_id']}"):
+                runner.cancel(job["job_id"])
+        elif job["state"] in jobs.RESUMABLE:
+            if job["error"]:
+                st.error(job["error"])
+            if st.button("Resume", key=f"resume-{job['job_id']}"):
+                runner.resume(job["job_id"])
+
+        summary = job["summary"] or {}
+        if summary.get("failed_bids"):
+            st.warning(f"Could not fetch {len(summary['failed_bids'])} business ids: "
+                       + ", ".join(bid for bid, _ in summary["failed_bids"]))
+        if job["metrics"]:
+            with st.expander(f"Job {job['job_id']} metrics"):
+                st.dataframe(job["metrics"])
+                if summary.get("metrics"):
+                    st.json(summary["metrics"])
+                if summary.get("sql"):
+                    st.dataframe(summary["sql"])
 
 st.set_page_config(
     page_title="Data Fetcher",
@@ -52,19 +131,27 @@ with st.sidebar:
 
     st.subheader(f"Database Info ({_ENV})")  # Add a section header
 
-    with DatabaseClient(env=_ENV) as db_client:
-        with st.spinner("Loading..."):
-            sql = "SELECT indicator, value FROM ipr_suomi_dbinfo"
-            info = db_client.query(sql)
-            st.dataframe(info)
+    with st.spinner("Loading..."):
+        st.dataframe(load_db_info(), hide_index=True)
+
+    # The jobs use the same engine as this client, so the statistics include their statements
+    if st.checkbox("Record SQL statement statistics", value=False):
+        sql_stats = get_db_client().instrument()
+        with st.expander(f"Top {SQL_REPORT_TOP} SQL statements by total time"):
+            st.dataframe(sql_stats.report(top=SQL_REPORT_TOP), hide_index=True)
+            if sql_stats.slow:
+                st.caption(f"{len(sql_stats.slow)} statements slower than {sql_stats.slow_threshold} s")
 
 # Create a horizontal selector using streamlit-pills
-options = ["#️⃣ Number of new records to fetch", "📃 List of business ids", "📁 File with a list of business ids"]
+options = ["#️⃣ Number of new records to fetch", "📃 List of business ids", "📁 File with a list of business ids",
+           "🔄 Re-check stored companies"]
 selected_option = pills("Select the input method:", options)
 
 get_records = None
 get_bids = None
 get_bids_fromfile = None
+recheck_budget = None
+skip_stored = False
 
 start_from = None
 
@@ -74,10 +161,24 @@ if selected_option == options[0]:
     start_from = st.text_input("Start from Business ID (optional):", "")
 elif selected_option == options[1]:
     get_bids = st.text_area("Enter a list of business ids to fetch, each on a new line:", "")
+    skip_stored = st.checkbox("Skip business ids already in the database", value=False)
 elif selected_option == options[2]:
     get_bids_fromfile = st.file_uploader('Choose a file', type=['txt'])
+    skip_stored = st.checkbox("Skip business ids already in the database", value=False)
+elif selected_option == options[3]:
+    recheck_budget = st.number_input("Max number of API calls to use (1-5000):", min_value=1, max_value=5000, value=100)
 
+skip_unchanged_names = st.checkbox("Skip previous names lookup for companies whose name has not changed", value=False)
+# Off by default: cached responses are stored as checked today, and a cached empty answer hides a new company
+use_cache = st.checkbox("Use the local YTJ response cache (responses up to 7 days old)", value=False)
+fast_parse = st.checkbox("Parse the raw response XML directly (fast parser)", value=False)
+resume = st.checkbox("Resume the last interrupted job instead", value=False)
+
+# The fetch runs as a background job, several jobs can run at the same time
 if st.button("Fetch Company Data"):
-    my_bar = st.progress(0, "Please wait")
-    fetch_data(my_bar, get_records, get_bids, get_bids_fromfile, start_from)
-    my_bar.progress(100, "Done!")
+    with st.spinner("Preparing the job..."):
+        submit_job(get_records, get_bids, get_bids_fromfile, start_from, skip_unchanged_names, use_cache,
+                   fast_parse, recheck_budget, resume, skip_stored)
+
+st.subheader("Jobs")
+show_jobs()
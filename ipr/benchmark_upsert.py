@@ -0,0 +1,71 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+# This allows us to import modules from the parent directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+
+from db_api.database import DatabaseClient
+
+# Scratch table with a composite key, like the applicants and inventors tables
+TABLE = "benchmark_upsert"
+
+def create_table(db_client):
+    with db_client._engine.begin() as connection:
+        connection.execute(text(f"DROP TABLE IF EXISTS {TABLE}"))
+        connection.execute(text(f"CREATE TABLE {TABLE} (lens_id varchar(40) NOT NULL, name varchar(200) NOT NULL, "
+                                f"address varchar(200), orcid varchar(40), PRIMARY KEY (lens_id, name))"))
+
+def make_rows(count, start=0, suffix=""):
+    return [{"lens_id": f"{i // 3:06d}-{i // 3 % 997:03d}-{i % 7}", "name": f"Inventor {i % 3}",
+             "address": f"Katu {i}{suffix}", "orcid": None} for i in range(start, start + count)]
+
+def row_loop(db_client, rows):
+    # The current way: one UPDATE, an INSERT if nothing was updated and a commit per row
+    for row in rows:
+        updated = db_client.query(f"UPDATE {TABLE} SET address = :address, orcid = :orcid "
+                                  f"WHERE lens_id = :lens_id AND name = :name", row)
+        if not updated:
+            db_client.query(f"INSERT INTO {TABLE} (lens_id, name, address, orcid) "
+                            f"VALUES (:lens_id, :name, :address, :orcid)", row)
+        db_client._session.commit()
+
+def bulk(db_client, rows):
+    db_client.upsert_many(TABLE, ["lens_id", "name"], rows)
+
+def timed(db_client, method, rows):
+    with db_client as db:
+        started = time.perf_counter()
+        method(db, rows)
+        return time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare upsert_many with the row by row upsert loop.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000], help='Numbers of rows per run')
+    parser.add_argument('--env', default='sqlite', help="Database: 'sqlite' (a temporary file), 'local' or 'live'")
+    args = parser.parse_args()
+
+    if args.env == 'sqlite' and 'SQLITE_PATH' not in os.environ:
+        os.environ['SQLITE_PATH'] = os.path.join(tempfile.mkdtemp(), 'benchmark.sqlite')
+    elif args.env != 'sqlite':
+        print(f"Note: the scratch table {TABLE} is created and dropped in the '{args.env}' database")
+
+    db_client = DatabaseClient(env=args.env)
+    print(f"{'rows':>7} {'method':10} {'insert s':>9} {'update s':>9} {'rows/s':>9}")
+    for size in args.sizes:
+        for name, method in (("row loop", row_loop), ("upsert_many", bulk)):
+            create_table(db_client)
+            # Half of the second round are updates of existing rows, half new ones
+            inserted = timed(db_client, method, make_rows(size))
+            updated = timed(db_client, method, make_rows(size, size // 2, "b"))
+            print(f"{size:7} {name:10} {inserted:9.2f} {updated:9.2f} {2 * size / (inserted + updated):9.0f}")
+
+    with db_client._engine.begin() as connection:
+        connection.execute(text(f"DROP TABLE {TABLE}"))
+
+if __name__ == "__main__":
+    main()
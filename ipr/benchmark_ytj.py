@@ -0,0 +1,124 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+from contextlib import nullcontext
+
+# This allows us to import modules from the parent directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+
+from db_api.database import DatabaseClient
+from ytj_api.ytj import YtjClient, COMPANY_COLUMNS
+from ytj_api.fakeytj import FakeYtjService
+
+# Tables written by the YTJ loaders, for the embedded SQLite database
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS companies (business_id varchar(9) PRIMARY KEY, company text NOT NULL, company_form text,
+    main_industry text, postal_code text, company_registration_date date, status text, hq text, checked date,
+    content_hash varchar(40));
+CREATE TABLE IF NOT EXISTS trade_names (business_id text, trade_name text, start_date date, end_date date);
+CREATE TABLE IF NOT EXISTS secondary_names (business_id text, secondary_name text, start_date date, end_date date);
+CREATE TABLE IF NOT EXISTS previous_names (business_id text, previous_name text, start_date date, end_date date);
+CREATE TABLE IF NOT EXISTS business_id_events (business_id_old text, business_id_new text, event_date date,
+    event_desc text);
+CREATE TABLE IF NOT EXISTS unused_businessids (bid text, checked date);
+CREATE TABLE IF NOT EXISTS ipr_suomi_stats (stat_key text PRIMARY KEY, indicator text NOT NULL, value bigint,
+    text_value text, updated datetime)
+"""
+
+TABLES = ("companies", "trade_names", "secondary_names", "previous_names", "business_id_events", "ipr_suomi_stats")
+
+# Ids of the runs start from here, far from the real ones
+FIRST_BID = 1000000
+
+def create_sqlite_tables(db_client):
+    with db_client._engine.begin() as connection:
+        for statement in SQLITE_SCHEMA.split(";"):
+            connection.execute(text(statement))
+
+def clear_tables(db_client):
+    with db_client._engine.begin() as connection:
+        for table in TABLES:
+            connection.execute(text(f"DELETE FROM {table} WHERE 1 = 1"))
+
+def run(ytj_client, db_client, bids, mode, workers):
+    """Run one benchmark round, return (seconds, stored companies, peak traced MB)."""
+    clear_tables(db_client)
+    tracemalloc.start()
+    started = time.perf_counter()
+
+    if mode == "batch":
+        # The original flow: fetch everything, then parse and store
+        companies = ytj_client.get_multiple(bids, workers=workers)
+        summary = ytj_client.store_companies_to_db(companies, COMPANY_COLUMNS, workers=workers)
+        stored = summary["changed"] + summary["unchanged"]
+    else:
+        summary = ytj_client.run_pipeline(bids, COMPANY_COLUMNS, workers=workers)
+        stored = summary["changed"] + summary["unchanged"]
+
+    seconds = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    tracemalloc.stop()
+    return seconds, stored, peak
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the YTJ loaders against a local fake YTJ service.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[500, 2000, 10000], help='Numbers of ids per run')
+    parser.add_argument('--modes', nargs='+', choices=['batch', 'pipeline'], default=['batch', 'pipeline'])
+    parser.add_argument('--env', default='sqlite', help="Database: 'sqlite' (a temporary file), 'local' or 'live'")
+    parser.add_argument('--wsdl', help='WSDL file, by default the bundled one')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--fast-parse', action='store_true', help='Use the lxml parser')
+    parser.add_argument('--latency', type=float, default=0.05, help='Fake service latency per request (s)')
+    parser.add_argument('--per-company-latency', type=float, default=0.001,
+                        help='Extra fake latency per company of a batch (s)')
+    parser.add_argument('--fault-rate', type=float, default=0.0, help='Share of requests answered with a fault')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests answered with HTTP 503')
+    parser.add_argument('--address', help='Use a fake service already running at this address, e.g. one started '
+                                          'with python -m ytj_api.fakeytj, so it does not share the CPU')
+    parser.add_argument('--output', help='Write the results to a JSON file')
+    args = parser.parse_args()
+
+    if args.env == 'sqlite' and 'SQLITE_PATH' not in os.environ:
+        os.environ['SQLITE_PATH'] = os.path.join(tempfile.mkdtemp(), 'benchmark.sqlite')
+    elif args.env != 'sqlite':
+        print(f"Note: the companies tables of the '{args.env}' database are emptied on every run")
+
+    db_client = DatabaseClient(env=args.env)
+    if args.env == 'sqlite':
+        create_sqlite_tables(db_client)
+
+    results = []
+    if args.address:
+        service = nullcontext()
+    else:
+        service = FakeYtjService(args.wsdl, latency=args.latency, per_company_latency=args.per_company_latency,
+                                 fault_rate=args.fault_rate, error_rate=args.error_rate)
+    with service:
+        address = args.address or service.address
+        ytj_client = YtjClient(args.wsdl, fast_parse=args.fast_parse, address=address)
+        ytj_client.set_database(db_client)
+
+        print(f"{'mode':10} {'ids':>7} {'companies':>10} {'seconds':>9} {'per second':>11} {'peak MB':>8}")
+        for size in args.sizes:
+            bids = ytj_client.generate_bids(FIRST_BID, size, skip_known=False)
+            for mode in args.modes:
+                seconds, companies, peak = run(ytj_client, db_client, bids, mode, args.workers)
+                results.append({"mode": mode, "ids": size, "companies": companies, "seconds": round(seconds, 3),
+                                "per_second": round(companies / seconds, 1), "peak_mb": round(peak, 1)})
+                print(f"{mode:10} {size:7} {companies:10} {seconds:9.2f} {companies / seconds:11.1f} {peak:8.1f}")
+
+        if not args.address:
+            print("Requests served:", service.requests)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({"settings": vars(args), "results": results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
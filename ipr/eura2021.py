@@ -1,7 +1,15 @@
+import os
+import sys
+import argparse
 import pandas as pd
 import numpy as np
 import warnings
 
+# This allows us to import modules from the parent directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db_api.database import DatabaseClient
+
 def read_eura2021_excel_to_dataframe():
     file_path = "eura2021_data.xlsx"
 
@@ -59,6 +67,15 @@ def read_eura2021_excel_to_dataframe():
     return df
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Read the EURA 2021 export and optionally load it to the database.')
+    parser.add_argument('--load', metavar='ENV', help="Append the rows to projects_eura2021 in 'live' or 'local'")
+    args = parser.parse_args()
+
     df = read_eura2021_excel_to_dataframe()
 
-    print(df.head())
\ No newline at end of file
+    print(df.head())
+
+    if args.load:
+        result = DatabaseClient(env=args.load).bulk_load(df, "projects_eura2021")
+        print(f"Loaded {result['rows']} rows in {result['seconds']} s ({result['rows_per_second']} rows/s, "
+              f"{result['method']})")
\ No newline at end of file
@@ -1,44 +1,89 @@
+import os
+import sys
 import argparse
-from ytj import YtjClient
-from database import DatabaseClient
+
+# This allows us to import modules from the parent directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db_api.database import DatabaseClient
+from ytj_api.ytj import YtjClient, COMPANY_COLUMNS
+from ytj_api.bidindex import BidIndex
+from ytj_api.scheduler import RecheckScheduler
+from ytj_api.journal import RunJournal
 
 def main():
     _GET_RECORDS = 1000
     _ENV = "live"  # "live" or "local", changes the database connection
 
-    with DatabaseClient(env=_ENV) as db_client:
-        if not db_client.connection:
-            print("Database connection failed. Exiting.")
-            return  # Exit the main function gracefully
-
-        ytj_client = YtjClient()
-
-        # Parse command line arguments
-        parser = argparse.ArgumentParser(description='Load business IDs from file or generate new ones.')
-        parser.add_argument('--file', help='File name for loading business IDs from')
-        args = parser.parse_args()
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description='Load business IDs from file or generate new ones.')
+    parser.add_argument('--file', help='File name for loading business IDs from')
+    parser.add_argument('--skip-stored', action='store_true',
+                        help='Leave out the business IDs of the file that are already in the database')
+    parser.add_argument('--budget', type=int,
+                        help='Re-check the stalest stored companies using at most this many API calls')
+    parser.add_argument('--metrics', metavar='FILE', help='Write the run summary and stage timings to a JSON file')
+    parser.add_argument('--resume', nargs='?', type=int, const=-1, metavar='RUN_ID',
+                        help='Continue an interrupted run, by default the latest one')
+    parser.add_argument('--sql-stats', nargs='?', type=int, const=10, metavar='N',
+                        help='Record the SQL statements and print the N slowest in total (default 10)')
+    args = parser.parse_args()
 
-        # Retrieve file name from arguments
-        file_name = args.file
+    db_client = DatabaseClient(env=_ENV)
+    if args.sql_stats:
+        db_client.instrument()
+    ytj_client = YtjClient()
+    ytj_client.set_database(db_client)
+    # Skips the ids already stored, known to be empty or checked recently, and is kept up to date by the run
+    bid_index = BidIndex.load_or_build(db_client)
+    ytj_client.set_bid_index(bid_index)
 
-        if file_name:
-            print("Loading business ids from file...")
-            bids = ytj_client.load_bids_from_file(file_name)
-        else:
-            print("Loading new business ids...")
-            latest_bid = ytj_client.get_latest_bid(db_client.connection)
-            next_bid = int(str(latest_bid[:7])) + 1
-            bids = ytj_client.generate_bids(next_bid, _GET_RECORDS)
+    journal = RunJournal()
+    resume_run = None
+    bids = None
 
-        print("Reading company information from YTJ...")
-        companies = ytj_client.get_multiple(bids)
+    # Retrieve file name from arguments
+    file_name = args.file
 
-        columns = ['y_tunnus', 'yritys', 'yhtiömuoto', 'toimiala', 'postinumero', 'yrityksen_rekisteröimispäivä', 'status', 'tarkastettu']
+    if args.resume is not None:
+        resume_run = journal.last_unfinished_run() if args.resume == -1 else args.resume
+        if resume_run is None:
+            print("No interrupted run to resume.")
+            return
+        print(f"Resuming run {resume_run}: {journal.progress(resume_run)}")
+    elif file_name:
+        print("Loading business ids from file...")
+        bids = ytj_client.load_bids_from_file(file_name, args.skip_stored)
+        print(f"Loaded {len(bids)} business ids")
+    elif args.budget:
+        print("Selecting stored companies to re-check...")
+        bids, calls = RecheckScheduler(db_client).plan(args.budget)
+        print(f"Re-checking {len(bids)} companies with about {calls} API calls")
+    else:
+        print("Loading new business ids...")
+        latest_bid = ytj_client.get_latest_bid()
+        next_bid = int(str(latest_bid[:7])) + 1
+        bids = ytj_client.generate_bids(next_bid, _GET_RECORDS)
 
-        print("Storing the company data to the database...")
-        ytj_client.store_companies_to_db(companies, columns, db_client.connection)
+    print("Reading company information from YTJ and storing it to the database...")
+    summary = ytj_client.run_pipeline(bids, COMPANY_COLUMNS, journal=journal, resume_run=resume_run,
+                                      metrics_path=args.metrics)
 
-        print("Last business id processed was", bids[-1])
+    print(f"Run {summary['run_id']} finished")
+    print(f"Stored {summary['companies']} companies from {summary['bids']} business ids")
+    print(f"{summary['changed']} changed, {summary['unchanged']} unchanged since the last check")
+    print(f"{summary['retries']} retried requests, {len(summary['failed_bids'])} business ids failed")
+    for bid, error in summary['failed_bids']:
+        print(f"  {bid}: {error}")
+    if summary['unstored_batches']:
+        print(f"{summary['unstored_batches']} batches with failed ids were left unstored, run again with --resume to retry them")
+    for row in ytj_client.metrics.rows():
+        print(f"  {row['stage']:6} {row['key']:24} {row['count']:6} calls {row['seconds']:9.2f} s"
+              f"  p95 {row['p95']} s")
+    bid_index.save()
+    print("Last business id processed was", summary['last_bid'])
+    if args.sql_stats:
+        print(db_client.sql_stats.format_report(top=args.sql_stats))
 
 if __name__ == "__main__":
     main()
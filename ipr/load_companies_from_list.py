@@ -1,35 +1,33 @@
-import re
-from datetime import datetime
-import progressbar
+import os
+import sys
 
-from database import DatabaseClient
-from ytj import YtjClient
+# This allows us to import modules from the parent directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db_api.database import DatabaseClient
+from ytj_api.ytj import YtjClient, COMPANY_COLUMNS
 
 _ENV = "local" # "live" or "local", changes the database connection
 
 def main():
     print("Initializing connection...")
     db_client = DatabaseClient(_ENV)
-    if db_client.connection is None:
-        exit()
-    db_client.connection.autocommit = True
 
     ytj_client = YtjClient()
+    ytj_client.set_database(db_client)
 
     print("Loading the business ids...")
     bids = ytj_client.load_bids_from_file("bids.txt")
 
-    print("Reading company information from YTJ...")
-    companies = ytj_client.get_multiple(bids)
-
-    columns = ['y_tunnus', 'yritys', 'yhtiömuoto', 'toimiala', 'postinumero', 'yrityksen_rekisteröimispäivä', 'status', 'tarkastettu']
-
-    print("Storing the company data to the database...")
-    ytj_client.store_companies_to_db(companies, columns, db_client.connection)
-
-    print("Last business id processed was", bids[-1])
+    print("Reading company information from YTJ and storing it to the database...")
+    summary = ytj_client.run_pipeline(bids, COMPANY_COLUMNS)
 
-    db_client.connection.close()
+    print(f"Stored {summary['companies']} companies from {summary['bids']} business ids")
+    print(f"{summary['changed']} changed, {summary['unchanged']} unchanged since the last check")
+    print(f"{summary['retries']} retried requests, {len(summary['failed_bids'])} business ids failed")
+    for bid, error in summary['failed_bids']:
+        print(f"  {bid}: {error}")
+    print("Last business id processed was", summary['last_bid'])
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
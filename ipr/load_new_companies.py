@@ -1,38 +1,42 @@
-from ytj import YtjClient
-from database import DatabaseClient
-from datetime import datetime
-import progressbar
+import os
+import sys
+
+# This allows us to import modules from the parent directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db_api.database import DatabaseClient
+from ytj_api.ytj import YtjClient, COMPANY_COLUMNS
+from ytj_api.bidindex import BidIndex
 
 def main():
     _GET_RECORDS = 5000
     _ENV = "local" # "live" or "local", changes the database connection
 
-    # Define the batch size for processing
-    _BATCH_SIZE = 50
-
     print("Initializing connection...")
     db_client = DatabaseClient(_ENV)
-    if db_client.connection is None:
-        exit()
 
-    db_client.connection.autocommit = True
     ytj_client = YtjClient()
+    ytj_client.set_database(db_client)
+    # Skips the ids already stored, known to be empty or checked recently, and is kept up to date by the run
+    bid_index = BidIndex.load_or_build(db_client)
+    ytj_client.set_bid_index(bid_index)
 
-    latest_bid = ytj_client.get_latest_bid(db_client.connection)
+    latest_bid = ytj_client.get_latest_bid()
     next_bid = int(str(latest_bid[:7])) + 1
 
     print("Loading new company information")
-    companies = ytj_client.load_new_companies(next_bid, _GET_RECORDS)
-
-    columns = ['y_tunnus', 'yritys', 'yhtiömuoto', 'toimiala', 'postinumero', 'yrityksen_rekisteröimispäivä', 'status', 'tarkastettu']
+    bids = ytj_client.generate_bids(next_bid, _GET_RECORDS)
 
     print("Storing the new company data to the database...")
-    ytj_client.store_companies_to_db(companies, columns, db_client.connection)
+    summary = ytj_client.run_pipeline(bids, COMPANY_COLUMNS)
 
-    print("Last business id processed was", bids[-1])
+    print(f"Stored {summary['companies']} companies from {summary['bids']} business ids")
+    print(f"{summary['changed']} changed, {summary['unchanged']} unchanged since the last check")
+    print(f"{summary['retries']} retried requests, {len(summary['failed_bids'])} business ids failed")
+    for bid, error in summary['failed_bids']:
+        print(f"  {bid}: {error}")
+    bid_index.save()
+    print("Last business id processed was", summary['last_bid'])
 
-#    cursor.close()
-    db_client.connection.close()
-  
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
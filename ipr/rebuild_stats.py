@@ -0,0 +1,24 @@
+import os
+import sys
+import argparse
+
+# This allows us to import modules from the parent directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db_api.database import DatabaseClient
+from db_api import stats
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Recompute the ipr_suomi_stats statistics from the tables. The loaders keep them up to date '
+                    'afterwards, this is only needed once or after manual changes to the data.')
+    parser.add_argument('--env', default='local', help="Database: 'live', 'local' or 'sqlite'")
+    args = parser.parse_args()
+
+    with DatabaseClient(env=args.env) as db_client:
+        print("Counting, this scans the company tables...")
+        for key, value in stats.rebuild(db_client).items():
+            print(f"{stats.label(key)}: {value}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+# This allows us to import modules from the parent directory
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+def time_import(module, repeat):
+    """Time importing `module` in fresh interpreters, return the best time in seconds."""
+    code = f"import sys, time; sys.path.append({ROOT!r}); t = time.perf_counter(); import {module}; " \
+           f"print(time.perf_counter() - t)"
+    times = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+        times.append(float(output.stdout.strip()))
+    return min(times)
+
+def time_clients(wsdl_url, count):
+    """Time building `count` clients with a new zeep.Client each and with the shared one."""
+    from zeep import Client
+    from ytj_api.ytj import YtjClient
+
+    start = time.perf_counter()
+    for _ in range(count):
+        Client(wsdl_url)
+    unshared = time.perf_counter() - start
+
+    start = time.perf_counter()
+    YtjClient(wsdl_url)
+    first = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(count):
+        YtjClient(wsdl_url)
+    shared = time.perf_counter() - start
+
+    return unshared, first, shared
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure ytj_api import and YtjClient construction times.')
+    parser.add_argument('--wsdl', help='WSDL file or URL, by default the bundled one')
+    parser.add_argument('--count', type=int, default=10, help='Number of clients to build')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of fresh interpreters per import')
+    args = parser.parse_args()
+
+    from ytj_api import soap
+    wsdl_url = args.wsdl or soap.DEFAULT_WSDL_PATH
+
+    print("Import times (best of {}):".format(args.repeat))
+    for module in ("ytj_api.ytj", "zeep", "numpy", "sqlalchemy"):
+        print(f"  {module:12} {time_import(module, args.repeat) * 1000:8.1f} ms")
+
+    unshared, first, shared = time_clients(wsdl_url, args.count)
+    print(f"Client construction ({args.count} clients):")
+    print(f"  new zeep.Client each  {unshared / args.count * 1000:8.1f} ms per client")
+    print(f"  first YtjClient       {first * 1000:8.1f} ms")
+    print(f"  shared YtjClient      {shared / args.count * 1000:8.1f} ms per client")
+
+if __name__ == "__main__":
+    main()
@@ -12,9 +12,31 @@ CREATE TABLE companies (
 	company_basename nvarchar(300) COLLATE SQL_Latin1_General_CP1_CI_AS NULL,
 	checked date NULL,
 	company_registration_date date NULL,
+	content_hash varchar(40) COLLATE SQL_Latin1_General_CP1_CI_AS NULL,
 	CONSTRAINT PK_companies PRIMARY KEY (business_id)
 );
 
+-- Existing databases: ALTER TABLE companies ADD content_hash varchar(40) NULL;
+
+-- DA_database.dbo.ipr_suomi_stats definition
+
+-- Statistics kept up to date by the loaders, see db_api/stats.py. Fill with ipr/rebuild_stats.py.
+CREATE TABLE ipr_suomi_stats (
+	stat_key nvarchar(150) COLLATE SQL_Latin1_General_CP1_CI_AS NOT NULL,
+	indicator nvarchar(200) COLLATE SQL_Latin1_General_CP1_CI_AS NOT NULL,
+	value bigint NULL,
+	text_value nvarchar(100) COLLATE SQL_Latin1_General_CP1_CI_AS NULL,
+	updated datetime NULL,
+	CONSTRAINT PK_ipr_suomi_stats PRIMARY KEY (stat_key)
+);
+
+-- Unique keys of the Lens tables, the upserts of LensApiClient.py use them with ON CONFLICT.
+-- Without them db_api falls back to slower select-then-update/insert upserts.
+-- Remove duplicate keys first if the tables already have them.
+CREATE UNIQUE INDEX ux_patents_lens_id ON patents (lens_id);
+CREATE UNIQUE INDEX ux_applicants_lens_id_extracted_name ON applicants (lens_id, extracted_name);
+CREATE UNIQUE INDEX ux_inventors_lens_id_name ON inventors (lens_id, name);
+
 -- DA_database.dbo.projects_eura2021 definition
 
 CREATE TABLE projects_eura2021 (
@@ -1,10 +1,9 @@
 -- dbo.ipr_suomi_dbinfo source
 
+-- Reads the statistics kept up to date by the loaders (db_api/stats.py), so reading it
+-- does not scan the big tables
 CREATE VIEW ipr_suomi_dbinfo AS
-SELECT 
-    'Viimeisin yrityksen rekisteröimispäivä' AS indicator, 
-    CAST((SELECT MAX(yrityksen_rekisteröimispäivä) FROM yritykset) AS CHAR) AS value
-UNION ALL
-SELECT 
-    'Yrityksiä tietokannassa' AS indicator, 
-    CAST((SELECT COUNT(*) FROM yritykset) AS CHAR) AS value;
+SELECT
+    indicator,
+    COALESCE(CAST(value AS nvarchar(30)), text_value) AS value
+FROM ipr_suomi_stats;
@@ -0,0 +1,79 @@
+"""
+Retry, backoff and batch size control for the YTJ batch requests.
+
+YtjClient fetches each batch with retries on transient errors, splits failing batches
+in half until the bad ids are isolated, and sizes its requests with AdaptiveBatchSize.
+FetchStats collects the counts reported in the run summary.
+"""
+import random
+import threading
+
+# Attempts per request on transient errors (timeouts, connection errors, HTTP errors)
+MAX_ATTEMPTS = 4
+
+# Backoff before retry n is about RETRY_BASE_DELAY * 2 ** n seconds, at most RETRY_MAX_DELAY
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+
+# Split requests allowed per run, more means a problem beyond a few bad ids and the run stops
+MAX_SPLITS = 100
+
+# Single ids fetched to tell a fault of the ids from one of the whole request, e.g. a bad API key
+FAULT_PROBES = 2
+
+# Smallest request size the adaptive batch size goes down to
+MIN_BATCH_SIZE = 10
+
+# Requests slower than this shrink the batch size (seconds)
+TARGET_LATENCY = 15.0
+
+def backoff_delay(attempt, base=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+    """Return the delay before retry `attempt` (0 = first retry), exponential with full jitter."""
+    return random.uniform(0, min(max_delay, base * 2 ** attempt))
+
+class AdaptiveBatchSize:
+    """
+    Request size that follows the observed latency and errors.
+
+    Additive increase, multiplicative decrease: every fast successful request grows the
+    size by `step` up to `maximum`, a slow one shrinks it by a quarter and a failed one
+    halves it, down to `minimum`. Shared between the worker threads.
+    """
+
+    def __init__(self, maximum, minimum=MIN_BATCH_SIZE, target_latency=TARGET_LATENCY, step=10):
+        self.maximum = maximum
+        self.minimum = min(minimum, maximum)
+        self.target_latency = target_latency
+        self.step = step
+        self.size = maximum
+        self._lock = threading.Lock()
+
+    def record(self, latency, ok=True):
+        with self._lock:
+            if not ok:
+                self.size = max(self.minimum, self.size // 2)
+            elif latency > self.target_latency:
+                self.size = max(self.minimum, self.size * 3 // 4)
+            else:
+                self.size = min(self.maximum, self.size + self.step)
+
+class FetchStats:
+    """Thread-safe counters of retried requests, split batches and isolated failed ids."""
+
+    def __init__(self):
+        self.retries = 0
+        self.splits = 0
+        self.failed_bids = []
+        self._lock = threading.Lock()
+
+    def add_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def add_split(self):
+        with self._lock:
+            self.splits += 1
+
+    def add_failure(self, bid, error):
+        with self._lock:
+            self.failed_bids.append((bid, str(error)))
@@ -0,0 +1,118 @@
+"""
+Streaming extraction of business ids from large text files and uploads.
+
+The text is read in chunks, the ids are found with one precompiled pattern per chunk
+and validated with the vectorized checksums of ytj_api.businessid. Duplicates are
+dropped with a bitmap over the id numbers, so memory stays flat however long the
+input is. Like before, only the first id of each line is taken.
+"""
+import io
+import re
+
+import numpy as np
+
+from ytj_api import businessid
+
+# First business id on each line of a chunk
+BID_PATTERN = re.compile(r'^.*?(\d{7}-\d)', re.M)
+
+# Characters read from the input at a time
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+_NBYTES = (businessid.MAX_NUMBER + 1 + 7) // 8
+
+def _get_bits(bitmap, numbers):
+    return ((bitmap[numbers >> 3] >> (numbers & 7)) & 1).astype(bool)
+
+def _set_bits(bitmap, numbers):
+    np.bitwise_or.at(bitmap, numbers >> 3, (1 << (numbers & 7)).astype(np.uint8))
+
+def iter_text_chunks(file, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield text chunks of a path, a text file object or a binary one (e.g. a Streamlit upload)."""
+    if isinstance(file, str):
+        with open(file, "r", encoding="utf-8", errors="replace") as f:
+            yield from iter_text_chunks(f, chunk_size)
+        return
+
+    if isinstance(file.read(0), bytes):
+        file = io.TextIOWrapper(file, encoding="utf-8", errors="replace")
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+def iter_line_blocks(chunks):
+    """Regroup text chunks into blocks that end at a line break, so no line is split."""
+    rest = ""
+    for chunk in chunks:
+        chunk = rest + chunk
+        cut = chunk.rfind("\n") + 1
+        rest = chunk[cut:]
+        if cut:
+            yield chunk[:cut]
+    if rest:
+        yield rest
+
+class BidScanner:
+    """
+    Finds new valid business ids in blocks of text.
+
+    Ids with a wrong check digit, ids already returned and ids set in the `exclude`
+    bitmap (e.g. the STORED bitmap of a BidIndex) are dropped. The counters tell how
+    many ids were dropped for each reason.
+    """
+
+    def __init__(self, exclude=None):
+        self.seen = np.zeros(_NBYTES, dtype=np.uint8)
+        self.exclude = exclude
+        self.found = 0
+        self.invalid = 0
+        self.duplicates = 0
+        self.excluded = 0
+
+    def scan(self, text):
+        """Return the new valid ids in `text`, in the order they appear."""
+        candidates = BID_PATTERN.findall(text)
+        if not candidates:
+            return []
+        self.found += len(candidates)
+
+        numbers, check_digits, wellformed = businessid.parse_bids(candidates)
+        valid = np.flatnonzero(wellformed & (businessid.checksums(numbers) == check_digits))
+        self.invalid += len(candidates) - len(valid)
+
+        # First occurrence of each id within the block, then the ones not seen in earlier blocks
+        _, first = np.unique(numbers[valid], return_index=True)
+        keep = valid[np.sort(first)]
+        keep = keep[~_get_bits(self.seen, numbers[keep])]
+        self.duplicates += len(valid) - len(keep)
+        _set_bits(self.seen, numbers[keep])
+
+        if self.exclude is not None:
+            known = _get_bits(self.exclude, numbers[keep])
+            self.excluded += int(known.sum())
+            keep = keep[~known]
+
+        return [candidates[i] for i in keep]
+
+    def stats(self):
+        return {"found": self.found, "invalid": self.invalid, "duplicates": self.duplicates,
+                "excluded": self.excluded}
+
+def iter_bids(file, exclude=None, chunk_size=DEFAULT_CHUNK_SIZE, scanner=None):
+    """Yield lists of new valid business ids from a file, see BidScanner."""
+    scanner = scanner or BidScanner(exclude)
+    for block in iter_line_blocks(iter_text_chunks(file, chunk_size)):
+        bids = scanner.scan(block)
+        if bids:
+            yield bids
+
+def stored_bitmap(db_client):
+    """Return a bitmap of the ids in the companies table, streamed with one query."""
+    bitmap = np.zeros(_NBYTES, dtype=np.uint8)
+    with db_client as db:
+        for rows in db.iter_query_chunks("SELECT business_id FROM companies"):
+            numbers, _, wellformed = businessid.parse_bids([row[0] for row in rows])
+            _set_bits(bitmap, numbers[wellformed])
+    return bitmap
@@ -0,0 +1,160 @@
+import os
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from ytj_api import businessid
+
+# Default location of the persisted index, next to this script
+DEFAULT_INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bid_index.npz")
+
+# Ids checked within this many days count as recently checked
+DEFAULT_RECENT_DAYS = 30
+
+# A persisted index older than this is rebuilt from the database by load_or_build (1 day)
+DEFAULT_MAX_AGE = 24 * 60 * 60
+
+# Flags of the index, each one is a bitmap over the 7-digit id numbers
+STORED = "stored"      # The id is in the companies table
+EMPTY = "empty"        # The id is in unused_businessids, YTJ has no company for it
+CHECKED = "checked"    # The id was fetched from YTJ recently
+FLAGS = (STORED, EMPTY, CHECKED)
+
+_NBYTES = (businessid.MAX_NUMBER + 1 + 7) // 8
+
+class BidIndex:
+    """
+    Bitmaps over the whole business id number space (0000000-9999999).
+
+    Each flag takes about 1.25 MB. Bit n of a bitmap is the id number n, the check digit
+    is not stored since it is determined by the number.
+    """
+
+    def __init__(self, bitmaps=None, created=None):
+        self.bitmaps = bitmaps or {flag: np.zeros(_NBYTES, dtype=np.uint8) for flag in FLAGS}
+        self.created = created or time.time()
+
+    @staticmethod
+    def _numbers(bids):
+        """Convert business id strings or id numbers to an int array of id numbers."""
+        bids = np.asarray(bids)
+        if bids.dtype.kind in "iu":
+            return bids.astype(np.int64).reshape(-1)
+        numbers, _, wellformed = businessid.parse_bids(bids)
+        return numbers[wellformed]
+
+    def mark(self, flag, bids):
+        """Set `flag` for the given business ids or id numbers."""
+        numbers = self._numbers(bids)
+        if len(numbers):
+            np.bitwise_or.at(self.bitmaps[flag], numbers >> 3, (1 << (numbers & 7)).astype(np.uint8))
+
+    def contains(self, flag, bids):
+        """Return a bool array telling which of the given ids have `flag` set."""
+        numbers = self._numbers(bids)
+        return ((self.bitmaps[flag][numbers >> 3] >> (numbers & 7)) & 1).astype(bool)
+
+    def known(self, bids):
+        """Return a bool array of the ids that are stored, empty or recently checked."""
+        numbers = self._numbers(bids)
+        combined = self.bitmaps[STORED][numbers >> 3] | self.bitmaps[EMPTY][numbers >> 3] \
+            | self.bitmaps[CHECKED][numbers >> 3]
+        return ((combined >> (numbers & 7)) & 1).astype(bool)
+
+    @classmethod
+    def from_db(cls, db_client, recent_days=DEFAULT_RECENT_DAYS):
+        """Build the index from the companies and unused_businessids tables."""
+        index = cls()
+        cutoff = (datetime.today() - timedelta(days=recent_days)).strftime('%Y-%m-%d')
+
+        # The ids are streamed and marked a chunk at a time, the tables are never all in memory
+        with db_client as db:
+            for rows in db.iter_query_chunks("SELECT business_id FROM companies"):
+                index.mark(STORED, [row[0] for row in rows])
+
+            for rows in db.iter_query_chunks("SELECT bid FROM unused_businessids"):
+                index.mark(EMPTY, [row[0] for row in rows])
+
+            for rows in db.iter_query_chunks(
+                    "SELECT business_id FROM companies WHERE checked >= :cutoff "
+                    "UNION SELECT bid FROM unused_businessids WHERE checked >= :cutoff",
+                    {"cutoff": cutoff}):
+                index.mark(CHECKED, [row[0] for row in rows])
+
+        return index
+
+    def save(self, path=DEFAULT_INDEX_PATH):
+        np.savez_compressed(path, created=np.array(self.created), **self.bitmaps)
+
+    @classmethod
+    def load(cls, path=DEFAULT_INDEX_PATH):
+        with np.load(path) as data:
+            return cls({flag: data[flag] for flag in FLAGS}, float(data["created"]))
+
+    @classmethod
+    def load_or_build(cls, db_client, path=DEFAULT_INDEX_PATH, max_age=DEFAULT_MAX_AGE):
+        """Load the persisted index, or build it from the database if it is missing or too old."""
+        if os.path.exists(path):
+            index = cls.load(path)
+            if time.time() - index.created <= max_age:
+                return index
+
+        index = cls.from_db(db_client)
+        index.save(path)
+        return index
+
+    def stats(self):
+        """Return the number of ids with each flag set."""
+        counts = {flag: int(np.unpackbits(bitmap).sum()) for flag, bitmap in self.bitmaps.items()}
+        counts["known"] = int(np.unpackbits(
+            self.bitmaps[STORED] | self.bitmaps[EMPTY] | self.bitmaps[CHECKED]).sum())
+        return counts
+
+    def density(self, block_size=10000, start=0, stop=businessid.MAX_NUMBER + 1):
+        """
+        Return per-block counts over the id numbers [start, stop).
+
+        Each row is a dict with the first id number of the block, the number of possible
+        valid ids in it, the stored and empty counts, the number of ids not known yet and
+        the share of stored ids among the ones checked so far.
+        """
+        start -= start % block_size
+        stop = min(stop, businessid.MAX_NUMBER + 1)
+
+        rows = []
+        for block_start in range(start, stop, block_size):
+            block_stop = min(block_start + block_size, stop)
+            valid = businessid.checksums(np.arange(block_start, block_stop)) >= 0
+            bits = {flag: self._bits(flag, block_start, block_stop) for flag in FLAGS}
+            known = bits[STORED] | bits[EMPTY] | bits[CHECKED]
+
+            stored = int(bits[STORED].sum())
+            empty = int(bits[EMPTY].sum())
+            rows.append({
+                "start": block_start,
+                "valid": int(valid.sum()),
+                "stored": stored,
+                "empty": empty,
+                "unknown": int((valid & ~known).sum()),
+                "density": stored / (stored + empty) if stored + empty else None,
+            })
+        return rows
+
+    def _bits(self, flag, start, stop):
+        """Return the bits of `flag` for the id numbers [start, stop) as a bool array."""
+        offset = start % 8
+        chunk = self.bitmaps[flag][start // 8:(stop + 7) // 8]
+        return np.unpackbits(chunk, bitorder="little")[offset:offset + stop - start].astype(bool)
+
+    def productive_ranges(self, top=10, block_size=10000):
+        """Return the blocks with unknown ids left, ordered by the density of stored ids."""
+        rows = [row for row in self.density(block_size) if row["unknown"] and row["density"] is not None]
+        rows.sort(key=lambda row: (row["density"], row["unknown"]), reverse=True)
+        return rows[:top]
+
+if __name__ == "__main__":
+    index = BidIndex.load()
+    print(index.stats())
+    for row in index.productive_ranges():
+        print(f"{row['start']:07d}: {row['density']:.0%} stored, {row['unknown']} unknown ids")
@@ -0,0 +1,103 @@
+"""
+Vectorized business id (Y-tunnus) checksums, generation and validation.
+
+A business id is seven digits, a dash and a check digit. The check digit is computed
+from the weighted sum of the seven digits modulo 11; ids where the remainder is 1 are
+never issued. Everything here works on whole NumPy arrays of id numbers at once.
+"""
+import numpy as np
+
+# Weights of the seven digits, from the most significant
+WEIGHTS = np.array([7, 9, 10, 5, 8, 4, 2], dtype=np.int64)
+POWERS = 10 ** np.arange(6, -1, -1, dtype=np.int64)
+
+# Number of the largest possible id, 9999999-x
+MAX_NUMBER = 9999999
+
+# Default amount of id numbers handled per NumPy operation when generating ranges
+DEFAULT_CHUNK_SIZE = 1_000_000
+
+def checksums(numbers):
+    """
+    Compute the check digits for an array of 7-digit id numbers.
+
+    Returns an int array with -1 for the numbers that can not be valid business ids.
+    """
+    numbers = np.asarray(numbers, dtype=np.int64)
+    digits = (numbers[..., None] // POWERS) % 10
+    mod = (digits @ WEIGHTS) % 11
+    out = np.where(mod == 0, 0, 11 - mod)
+    out[mod == 1] = -1
+    return out
+
+def format_bids(numbers, check_digits):
+    """Format arrays of id numbers and check digits as 'NNNNNNN-C' strings."""
+    numbers = np.asarray(numbers, dtype=np.int64)
+    check_digits = np.asarray(check_digits, dtype=np.int64)
+    body = np.char.zfill(numbers.astype("U7"), 7)
+    return np.char.add(np.char.add(body, "-"), check_digits.astype("U1"))
+
+def valid_range(start, stop):
+    """Return (numbers, check_digits) of the valid ids in the number range [start, stop)."""
+    numbers = np.arange(max(start, 0), min(stop, MAX_NUMBER + 1), dtype=np.int64)
+    check_digits = checksums(numbers)
+    valid = check_digits >= 0
+    return numbers[valid], check_digits[valid]
+
+def iter_valid_numbers(start, count=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield (numbers, check_digits) arrays of valid ids starting from the number `start`.
+
+    Stops after `count` valid ids, or at the end of the id space when count is None.
+    """
+    while start <= MAX_NUMBER and (count is None or count > 0):
+        size = chunk_size if count is None else min(chunk_size, count + count // 10 + 10)
+        numbers, check_digits = valid_range(start, start + size)
+        if count is not None:
+            numbers, check_digits = numbers[:count], check_digits[:count]
+            count -= len(numbers)
+        start += size
+        if len(numbers):
+            yield numbers, check_digits
+
+def iter_bids(start, count=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield arrays of formatted valid business ids, see iter_valid_numbers."""
+    for numbers, check_digits in iter_valid_numbers(start, count, chunk_size):
+        yield format_bids(numbers, check_digits)
+
+def generate_bids(start, count):
+    """Return a list of `count` valid business ids starting from the number `start`."""
+    bids = []
+    for chunk in iter_bids(start, count):
+        bids.extend(chunk.tolist())
+    return bids
+
+def parse_bids(bids):
+    """
+    Split an array of 'NNNNNNN-C' strings into numbers and check digits.
+
+    Returns (numbers, check_digits, wellformed) where wellformed is False for the
+    strings that do not have exactly that format; their numbers are undefined.
+    """
+    full = np.asarray(bids, dtype=str).reshape(-1)
+    # Longer strings would be truncated by the U9 dtype, so the length is checked separately
+    lengths = np.char.str_len(full)
+    arr = full.astype("U9")
+
+    codes = arr.view(np.uint32).reshape(len(arr), 9).astype(np.int64) - ord("0")
+    digit_positions = np.r_[0:7, 8]
+    wellformed = (
+        (lengths == 9)
+        & np.all((codes[:, digit_positions] >= 0) & (codes[:, digit_positions] <= 9), axis=1)
+        & (codes[:, 7] == ord("-") - ord("0"))
+    )
+
+    digits = np.clip(codes[:, :7], 0, 9)
+    numbers = digits @ POWERS
+    check_digits = codes[:, 8]
+    return numbers, check_digits, wellformed
+
+def check_bids(bids):
+    """Return a bool array telling which of the given business ids are valid."""
+    numbers, check_digits, wellformed = parse_bids(bids)
+    return wellformed & (checksums(numbers) == check_digits)
@@ -0,0 +1,157 @@
+import os
+import time
+import zlib
+import pickle
+import sqlite3
+import threading
+
+# Default location of the cache database, next to this script
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ytj_cache.sqlite")
+
+# Cached responses older than this are treated as missing (7 days)
+DEFAULT_TTL = 7 * 24 * 60 * 60
+
+# When the payloads take more than this, least recently used entries are evicted (1 GB)
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+# Expired entries are deleted every this many put_many calls, and whenever the size limit is passed
+EXPIRE_INTERVAL = 100
+
+class ResponseCache:
+    """
+    Persistent SQLite cache for raw YTJ responses.
+
+    Entries are keyed by (operation, business id) and hold the serialized response as a
+    compressed pickle. A cached value of None means that YTJ returned nothing for the id.
+    The cache can be shared between the worker threads of YtjClient.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                operation TEXT NOT NULL,
+                business_id TEXT NOT NULL,
+                fetched REAL NOT NULL,
+                accessed REAL NOT NULL,
+                size INTEGER NOT NULL,
+                payload BLOB NOT NULL,
+                PRIMARY KEY (operation, business_id)
+            )""")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_fetched ON responses (fetched)")
+        self._connection.commit()
+        # Running total of the payload sizes, so that a put does not scan the table. Replaced
+        # entries are counted twice, the total is recomputed exactly by _evict.
+        self._size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def get_many(self, operation, bids):
+        """Return a {business_id: value} dict of the fresh cached entries among `bids`."""
+        now = time.time()
+        found = {}
+        with self._lock:
+            for i in range(0, len(bids), 500):
+                chunk = list(bids[i:i + 500])
+                placeholders = ", ".join("?" * len(chunk))
+                rows = self._connection.execute(
+                    f"SELECT business_id, fetched, payload FROM responses "
+                    f"WHERE operation = ? AND business_id IN ({placeholders})",
+                    [operation] + chunk).fetchall()
+                for business_id, fetched, payload in rows:
+                    if self.ttl is None or now - fetched <= self.ttl:
+                        found[business_id] = pickle.loads(zlib.decompress(payload))
+
+            if found:
+                self._connection.executemany(
+                    "UPDATE responses SET accessed = ? WHERE operation = ? AND business_id = ?",
+                    [(now, operation, bid) for bid in found])
+                self._connection.commit()
+
+            self.hits += len(found)
+            self.misses += len(bids) - len(found)
+        return found
+
+    def get(self, operation, bid, default=None):
+        """Return the cached value for one business id, or `default` if there is none."""
+        return self.get_many(operation, [bid]).get(bid, default)
+
+    def __contains__(self, key):
+        operation, bid = key
+        return bid in self.get_many(operation, [bid])
+
+    def put_many(self, operation, items):
+        """Store (business_id, value) pairs and evict old entries now and then, see _evict."""
+        now = time.time()
+        rows = []
+        for bid, value in items:
+            payload = zlib.compress(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+            rows.append((operation, bid, now, now, len(payload), payload))
+
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO responses (operation, business_id, fetched, accessed, size, payload) "
+                "VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self._connection.commit()
+            self._size += sum(row[4] for row in rows)
+            self._writes += 1
+            if self._writes % EXPIRE_INTERVAL == 0 or (self.max_bytes is not None and self._size > self.max_bytes):
+                self._evict()
+
+    def put(self, operation, bid, value):
+        self.put_many(operation, [(bid, value)])
+
+    def _evict(self):
+        """Drop expired entries and then least recently used ones until under max_bytes."""
+        if self.ttl is not None:
+            self._connection.execute("DELETE FROM responses WHERE fetched < ?", (time.time() - self.ttl,))
+
+        if self.max_bytes is not None:
+            total = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            self._size = total
+            if total > self.max_bytes:
+                # Evict down to 90% so that every put near the limit does not trigger a new eviction
+                excess = total - int(self.max_bytes * 0.9)
+                removed = 0
+                victims = []
+                for operation, bid, size in self._connection.execute(
+                        "SELECT operation, business_id, size FROM responses ORDER BY accessed"):
+                    victims.append((operation, bid))
+                    removed += size
+                    if removed >= excess:
+                        break
+                self._connection.executemany(
+                    "DELETE FROM responses WHERE operation = ? AND business_id = ?", victims)
+                self._size -= removed
+        self._connection.commit()
+
+    def clear(self, operation=None):
+        with self._lock:
+            if operation is None:
+                self._connection.execute("DELETE FROM responses")
+            else:
+                self._connection.execute("DELETE FROM responses WHERE operation = ?", (operation,))
+            self._connection.commit()
+            self._size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def stats(self):
+        """Return entry counts and sizes per operation, and the hit/miss counters."""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT operation, COUNT(*), COALESCE(SUM(size), 0) FROM responses GROUP BY operation").fetchall()
+        return {
+            "operations": {operation: {"entries": count, "bytes": size} for operation, count, size in rows},
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,250 @@
+"""
+Local stand-in for the YTJ SOAP service, for benchmarks and testing without API quota.
+
+FakeYtjService answers wmYritysTiedotMassahaku, wmToiminimi and wmYritysHaku over HTTP.
+The responses are rendered with zeep from the same WSDL the client uses, so they have
+the structure of real responses. The company data is synthetic but deterministic: the
+same business id always gets the same company. Latency, SOAP faults and HTTP errors
+can be injected.
+
+    service = FakeYtjService(latency=0.2, fault_rate=0.01).start()
+    client = YtjClient(address=service.address)
+"""
+import time
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from lxml import etree
+
+from ytj_api import soap
+
+# Share of the requested ids that get no company, like unused ids in the real service
+DEFAULT_EMPTY_RATE = 0.15
+
+# Company forms and their shares among the synthetic companies
+COMPANY_FORMS = (
+    ("Osakeyhtiö", 0.55),
+    ("Yksityinen elinkeinonharjoittaja", 0.25),
+    ("Avoin yhtiö", 0.05),
+    ("Kommandiittiyhtiö", 0.07),
+    ("Osuuskunta", 0.03),
+    ("Julkinen osakeyhtiö", 0.01),
+    ("Asunto-osakeyhtiö", 0.04),
+)
+
+INDUSTRIES = (
+    ("62010", "Ohjelmistojen suunnittelu ja valmistus"),
+    ("70200", "Liikkeenjohdon konsultointi"),
+    ("41200", "Asuin- ja muiden rakennusten rakentaminen"),
+    ("47190", "Muu vähittäiskauppa erikoistumattomissa myymälöissä"),
+    ("56101", "Ravintolat"),
+    ("49410", "Tieliikenteen tavarankuljetus"),
+    ("68200", "Omien tai leasing-kiinteistöjen vuokraus ja hallinta"),
+)
+
+TOWNS = ("HELSINKI", "ESPOO", "TAMPERE", "VANTAA", "OULU", "TURKU", "JYVÄSKYLÄ", "KOTKA", "MIKKELI")
+
+NAME_PARTS = ("Pohjan", "Järvi", "Metsä", "Kivi", "Tieto", "Rakennus", "Kone", "Sähkö", "Puu", "Meri", "Kaupunki")
+
+SOAP_NS = "http://schemas.xmlsoap.org/soap/envelope/"
+
+def _date(r, start_year=1950, end_year=2024):
+    return f"{r.randint(1, 28)}.{r.randint(1, 12)}.{r.randint(start_year, end_year)}"
+
+def _choose_form(r):
+    x = r.random()
+    for form, share in COMPANY_FORMS:
+        x -= share
+        if x < 0:
+            return form
+    return COMPANY_FORMS[0][0]
+
+def _name(r):
+    return f"{r.choice(NAME_PARTS)}{r.choice(NAME_PARTS).lower()}"
+
+def fake_company(bid):
+    """Return the synthetic company of a business id as a dict of the response fields."""
+    r = random.Random(bid)
+    form = _choose_form(r)
+    suffix = {"Osakeyhtiö": " Oy", "Julkinen osakeyhtiö": " Oyj", "Avoin yhtiö": " Ay",
+              "Kommandiittiyhtiö": " Ky", "Osuuskunta": " osk", "Asunto-osakeyhtiö": " As Oy"}.get(form, "")
+    name = _name(r) + suffix
+    code, industry = r.choice(INDUSTRIES)
+    ended = r.random() < 0.1
+
+    company = {
+        "YritysTunnus": {"YTunnus": bid, "Alkupvm": _date(r),
+                         "YrityksenLopettamisenSyy": r.choice(["Konkurssi", "Sulautuminen"]) if ended else None},
+        "Toiminimi": {"Toiminimi": name, "AlkuPvm": _date(r)},
+        "ElinkeinoToiminta": {"Seloste": "Elinkeinotoiminta päättynyt" if ended and r.random() < 0.5
+                              else "Elinkeinotoiminta jatkuu"},
+        "Toimiala": {"Koodi": code, "Seloste": industry},
+        "YrityksenPostiOsoite": {"Postinumero": f"{r.randint(0, 99):02d}{r.randint(0, 9)}{r.randint(0, 9)}0"},
+        "Kotipaikka": {"Seloste": r.choice(TOWNS)},
+        "Yritysmuoto": {"Seloste": form},
+    }
+    if form == "Yksityinen elinkeinonharjoittaja":
+        company["YrityksenHenkilo"] = {"Nimi": f"{_name(r)} {_name(r)}"}
+    if r.random() < 0.3:
+        company["Aputoiminimet"] = {"ToiminimiDTO": [
+            {"Toiminimi": _name(r), "AlkuPvm": _date(r, 1990), "LoppuPvm": r.choice([None, _date(r, 2000)])}
+            for _ in range(r.randint(1, 3))]}
+    if r.random() < 0.1:
+        company["Rinnakkaistoiminimet"] = {"ToiminimiDTO": [
+            {"Toiminimi": f"{name} Ab", "AlkuPvm": _date(r, 1990), "LoppuPvm": None}]}
+    if r.random() < 0.05:
+        company["YritystunnusHistoria"] = {"YritysTunnusHistoriaDTO": [
+            {"YTunnusVanha": f"{r.randint(0, 999999):07d}-{r.randint(0, 9)}", "YTunnusUusi": bid,
+             "Muutospvm": _date(r, 1995), "Tapahtuma": "Sulautuminen"}]}
+    return company
+
+def fake_previous_names(bid):
+    """Return the synthetic wmToiminimi result of a business id."""
+    r = random.Random("previous:" + bid)
+    items = [{"Tieto": _name(r) + " Oy", "Alkupvm": _date(r, 1980, 2000), "Loppupvm": _date(r, 2001)}
+             for _ in range(r.choice([0, 0, 1, 2]))]
+    return {"EdellinenTieto": {"YTieto": items}} if items else {}
+
+def _fault(message):
+    return (f'<?xml version="1.0" encoding="utf-8"?><soap:Envelope xmlns:soap="{SOAP_NS}"><soap:Body>'
+            f'<soap:Fault><faultcode>soap:Server</faultcode><faultstring>{message}</faultstring>'
+            f'</soap:Fault></soap:Body></soap:Envelope>').encode("utf-8")
+
+class FakeYtjService:
+    """
+    HTTP server answering like the YTJ service.
+
+    latency (seconds) is added to every response, plus up to `jitter` seconds, and
+    per_company_latency for each company of a batch. fault_rate and error_rate are the
+    shares of requests answered with a SOAP fault or an HTTP 503. Requests that contain
+    any of `bad_bids` always get a SOAP fault, like an id the real service rejects. With
+    auth_fault, every request gets an authentication fault, like with an expired API key.
+    The request counters tell how the client used the service.
+    """
+
+    def __init__(self, wsdl_url=None, latency=0.0, jitter=0.0, per_company_latency=0.0, fault_rate=0.0,
+                 error_rate=0.0, empty_rate=DEFAULT_EMPTY_RATE, bad_bids=(), auth_fault=False, seed=None):
+        self.client = soap.get_client(wsdl_url)
+        self.binding = self.client.service._binding
+        self.latency = latency
+        self.jitter = jitter
+        self.per_company_latency = per_company_latency
+        self.fault_rate = fault_rate
+        self.error_rate = error_rate
+        self.empty_rate = empty_rate
+        self.bad_bids = set(bad_bids)
+        self.auth_fault = auth_fault
+        self.requests = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def address(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self, host="127.0.0.1", port=0):
+        """Start serving in a background thread, port 0 picks a free port. Returns self."""
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                status, payload = service.handle(body)
+                self.send_response(status)
+                self.send_header("Content-Type", "text/xml; charset=utf-8")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start() if self._server is None else self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def handle(self, body):
+        """Answer one SOAP request body, return (HTTP status, response bytes)."""
+        request = etree.fromstring(body)
+        operation_elem = request.find(f"{{{SOAP_NS}}}Body")[0]
+        operation = etree.QName(operation_elem).localname
+        params = {etree.QName(child).localname: child.text for child in operation_elem}
+
+        with self._lock:
+            self.requests[operation] = self.requests.get(operation, 0) + 1
+            roll = self._random.random()
+
+        bids = [bid for bid in (params.get("ytunnus") or "").split(";") if bid]
+        delay = self.latency + self._random.uniform(0, self.jitter)
+        if operation == "wmYritysTiedotMassahaku":
+            delay += self.per_company_latency * len(bids)
+        if delay:
+            time.sleep(delay)
+
+        if self.auth_fault:
+            return 500, _fault("Tunnistautuminen epäonnistui")
+        if roll < self.error_rate:
+            return 503, b""
+        if roll < self.error_rate + self.fault_rate or self.bad_bids.intersection(bids):
+            return 500, _fault("Palvelussa tapahtui virhe")
+
+        if operation == "wmYritysTiedotMassahaku":
+            companies = [fake_company(bid) for bid in bids
+                         if random.Random("empty:" + bid).random() >= self.empty_rate]
+            result = {"YritysTiedotV2DTO": companies}
+        elif operation == "wmToiminimi":
+            result = fake_previous_names(bids[0]) if bids else {}
+        elif operation == "wmYritysHaku":
+            result = {}
+        else:
+            return 500, _fault(f"Tuntematon operaatio {operation}")
+
+        return 200, self.render(operation, result)
+
+    def render(self, operation, result):
+        """Render a response envelope of `operation` with zeep, from the WSDL."""
+        output = self.binding._operations[operation].output
+        result_name = output.body.type.elements[0][0]
+        message = output.serialize(**{result_name: result})
+        return etree.tostring(message.content, xml_declaration=True, encoding="utf-8")
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run a fake YTJ SOAP service.')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--wsdl', help='WSDL file, by default the bundled one')
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--per-company-latency', type=float, default=0.0)
+    parser.add_argument('--fault-rate', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    service = FakeYtjService(args.wsdl, latency=args.latency, jitter=args.jitter,
+                             per_company_latency=args.per_company_latency, fault_rate=args.fault_rate,
+                             error_rate=args.error_rate).start(port=args.port)
+    print(f"Fake YTJ service at {service.address}, Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        service.stop()
@@ -0,0 +1,274 @@
+"""
+Background jobs for fetching companies from YTJ.
+
+A job is a journaled YtjClient.run_pipeline run executed in a worker thread of a
+JobRunner, so a long fetch does not block the Streamlit script and keeps running when
+the page is rerun or reloaded. Jobs and their progress are kept in a SQLite table next
+to the run journal. Several jobs can run at the same time, and they share one token
+bucket so that together they stay under the API rate limit.
+
+    runner = JobRunner(env="live")
+    job_id = runner.submit(bids, "New companies from 3456789")
+    runner.get(job_id)["state"]
+    runner.cancel(job_id)
+"""
+import json
+import time
+import queue
+import sqlite3
+import threading
+from itertools import islice
+
+from db_api.database import DatabaseClient
+from ytj_api import journal as runjournal
+from ytj_api.ratelimit import TokenBucket
+from ytj_api.ytj import YtjClient, MAX_BATCH_SIZE
+
+# States of a job
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+INTERRUPTED = "interrupted"  # The process stopped while the job was queued or running
+
+# Jobs in these states can be resumed from the batches they did not store
+RESUMABLE = (FAILED, CANCELLED, INTERRUPTED)
+
+# Jobs run at the same time by default
+DEFAULT_MAX_JOBS = 2
+
+# API calls per second shared by all the jobs, and the burst allowed after idle time
+DEFAULT_RATE = 5
+DEFAULT_BURST = 10
+
+# Fetch workers per job, fewer than a single run uses since the jobs share the rate
+DEFAULT_JOB_WORKERS = 2
+
+_COLUMNS = ("job_id", "description", "run_id", "state", "options", "submitted", "started", "finished",
+            "total", "bids", "companies", "metrics", "summary", "error")
+
+class JobStore:
+    """Persistent SQLite table of the jobs, safe to use from several threads."""
+
+    def __init__(self, path=runjournal.DEFAULT_JOURNAL_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                description TEXT,
+                run_id INTEGER NOT NULL,
+                state TEXT NOT NULL,
+                options TEXT NOT NULL,
+                submitted REAL NOT NULL,
+                started REAL,
+                finished REAL,
+                total INTEGER NOT NULL,
+                bids INTEGER NOT NULL DEFAULT 0,
+                companies INTEGER NOT NULL DEFAULT 0,
+                metrics TEXT,
+                summary TEXT,
+                error TEXT
+            )""")
+        self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def add(self, run_id, total, description=None, options=None):
+        with self._lock:
+            cursor = self._connection.execute(
+                "INSERT INTO jobs (description, run_id, state, options, submitted, total) VALUES (?, ?, ?, ?, ?, ?)",
+                (description, run_id, QUEUED, json.dumps(options or {}), time.time(), total))
+            self._connection.commit()
+        return cursor.lastrowid
+
+    def update(self, job_id, **values):
+        for key in ("options", "metrics", "summary"):
+            if key in values and values[key] is not None:
+                values[key] = json.dumps(values[key], default=str)
+        assignments = ", ".join(f"{key} = ?" for key in values)
+        with self._lock:
+            self._connection.execute(f"UPDATE jobs SET {assignments} WHERE job_id = ?",
+                                     list(values.values()) + [job_id])
+            self._connection.commit()
+
+    def _to_dict(self, row):
+        job = dict(zip(_COLUMNS, row))
+        for key in ("options", "metrics", "summary"):
+            if job[key] is not None:
+                job[key] = json.loads(job[key])
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._connection.execute(
+                f"SELECT {', '.join(_COLUMNS)} FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def recent(self, limit=20):
+        """Return the latest jobs as dicts, newest first."""
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT {', '.join(_COLUMNS)} FROM jobs ORDER BY job_id DESC LIMIT ?", (limit,)).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def mark_interrupted(self):
+        """Mark the jobs left queued or running by an earlier process as interrupted."""
+        with self._lock:
+            self._connection.execute("UPDATE jobs SET state = ? WHERE state IN (?, ?)",
+                                     (INTERRUPTED, QUEUED, RUNNING))
+            self._connection.commit()
+
+class JobRunner:
+    """
+    Runs fetch jobs in background worker threads.
+
+    Each job gets its own YtjClient and database session, and all of them share one
+    TokenBucket and response cache. A job is recorded as a RunJournal run when it is
+    submitted, so a cancelled, failed or interrupted job can be resumed from the batches
+    it did not store. Progress and stage metrics are written to the job table after
+    every stored batch.
+
+    Create one runner per process, e.g. with st.cache_resource: jobs left running by an
+    earlier process are marked interrupted when a runner is created.
+    """
+
+    def __init__(self, env="live", max_jobs=DEFAULT_MAX_JOBS, rate=DEFAULT_RATE, burst=DEFAULT_BURST,
+                 workers=DEFAULT_JOB_WORKERS, cache=None, journal_path=runjournal.DEFAULT_JOURNAL_PATH,
+                 wsdl_url=None):
+        self.env = env
+        self.workers = workers
+        self.cache = cache
+        self.wsdl_url = wsdl_url
+        self.rate_limiter = TokenBucket(rate, burst)
+        self.journal = runjournal.RunJournal(journal_path)
+        self.store = JobStore(journal_path)
+        self.store.mark_interrupted()
+
+        self._queue = queue.Queue()
+        self._cancel_events = {}
+        self._bid_indexes = {}
+        self._lock = threading.Lock()
+        self._threads = [threading.Thread(target=self._work, daemon=True) for _ in range(max(1, max_jobs))]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, bids, description=None, bid_index=None, **options):
+        """
+        Queue a job fetching `bids`, return its id.
+
+        The options are passed to run_pipeline (e.g. skip_unchanged_names) or select the
+        YtjClient settings (fast_parse, use_cache). With a BidIndex, the job marks the
+        ids it checks and stores in it and saves it when done.
+        """
+        run_id = self.journal.start_run(_batches(bids), description)
+        total = self.journal.unfinished_count(run_id)
+        job_id = self.store.add(run_id, total, description, options)
+        self._enqueue(job_id, bid_index)
+        return job_id
+
+    def resume(self, job_id):
+        """Queue a cancelled, failed or interrupted job again, it continues from its unstored batches."""
+        job = self.store.get(job_id)
+        if job is None:
+            raise ValueError(f"No such job: {job_id}")
+        if job["state"] not in RESUMABLE:
+            raise RuntimeError(f"Job {job_id} is {job['state']}, it cannot be resumed.")
+        self.store.update(job_id, state=QUEUED, finished=None, error=None)
+        self._enqueue(job_id, None)
+        return job_id
+
+    def last_resumable(self):
+        """Return the id of the latest job that can be resumed, or None."""
+        for job in self.store.recent():
+            if job["state"] in RESUMABLE:
+                return job["job_id"]
+        return None
+
+    def cancel(self, job_id):
+        """Ask a queued or running job to stop, a running one stops after its current batch."""
+        with self._lock:
+            event = self._cancel_events.get(job_id)
+        if event is None:
+            return False
+        event.set()
+        return True
+
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+    def jobs(self, limit=20):
+        return self.store.recent(limit)
+
+    def _enqueue(self, job_id, bid_index):
+        with self._lock:
+            self._cancel_events[job_id] = threading.Event()
+            if bid_index is not None:
+                self._bid_indexes[job_id] = bid_index
+        self._queue.put(job_id)
+
+    def _work(self):
+        while True:
+            job_id = self._queue.get()
+            try:
+                self._run(job_id)
+            finally:
+                with self._lock:
+                    self._cancel_events.pop(job_id, None)
+                    self._bid_indexes.pop(job_id, None)
+
+    def _run(self, job_id):
+        job = self.store.get(job_id)
+        with self._lock:
+            cancel = self._cancel_events[job_id]
+            bid_index = self._bid_indexes.get(job_id)
+        if cancel.is_set():
+            self.store.update(job_id, state=CANCELLED, finished=time.time())
+            return
+
+        options = dict(job["options"])
+        # The cache is opt-in, the stored companies are marked checked today even if the response is older
+        use_cache = options.pop("use_cache", False)
+        fast_parse = options.pop("fast_parse", False)
+        # A resumed job continues from the batches it stored before
+        done = job["total"] - self.journal.unfinished_count(job["run_id"])
+        self.store.update(job_id, state=RUNNING, started=time.time(), bids=done)
+
+        def report(summary):
+            self.store.update(job_id, bids=done + summary["bids"], companies=job["companies"] + summary["companies"],
+                              metrics=ytj_client.metrics.rows())
+
+        try:
+            with DatabaseClient(env=self.env) as db_client:
+                ytj_client = YtjClient(self.wsdl_url, cache=self.cache if use_cache else None, fast_parse=fast_parse)
+                ytj_client.set_database(db_client)
+                ytj_client.set_rate_limiter(self.rate_limiter)
+                if bid_index is not None:
+                    ytj_client.set_bid_index(bid_index)
+
+                summary = ytj_client.run_pipeline(None, workers=self.workers, journal=self.journal,
+                                                  resume_run=job["run_id"], on_batch=report, cancel=cancel,
+                                                  **options)
+                report(summary)
+                if bid_index is not None:
+                    bid_index.save()
+        except Exception as e:
+            self.store.update(job_id, state=FAILED, finished=time.time(), error=str(e))
+            print(f"Job {job_id} failed: {e}")
+            return
+
+        self.store.update(job_id, state=CANCELLED if summary["cancelled"] else DONE, finished=time.time(),
+                          summary=summary)
+
+def _batches(bids):
+    """Split the ids into the batches of the journal run, like run_pipeline does."""
+    bids = iter(bids)
+    while True:
+        batch = list(islice(bids, MAX_BATCH_SIZE))
+        if not batch:
+            return
+        yield batch
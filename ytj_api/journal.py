@@ -0,0 +1,120 @@
+import os
+import time
+import sqlite3
+import threading
+
+# Default location of the journal database, next to this script
+DEFAULT_JOURNAL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ytj_journal.sqlite")
+
+# Batches read at a time by iter_unfinished_batches
+READ_CHUNK_SIZE = 100
+
+# States of a batch, in the order the pipeline moves them through
+PENDING = "pending"
+FETCHED = "fetched"
+PARSED = "parsed"
+STORED = "stored"
+
+class RunJournal:
+    """
+    Persistent SQLite journal of YtjClient.run_pipeline runs.
+
+    A run is split into numbered batches up front, and each batch moves through the
+    states pending, fetched, parsed and stored as the pipeline handles it. A batch is
+    only marked stored after its transaction is committed, so an interrupted run can be
+    resumed from the batches that are not stored yet. The journal can be shared between
+    the pipeline threads.
+    """
+
+    def __init__(self, path=DEFAULT_JOURNAL_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (
+                run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                description TEXT,
+                started REAL NOT NULL,
+                finished REAL
+            );
+            CREATE TABLE IF NOT EXISTS batches (
+                run_id INTEGER NOT NULL,
+                seq INTEGER NOT NULL,
+                bids TEXT NOT NULL,
+                state TEXT NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (run_id, seq)
+            );
+        """)
+        self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def start_run(self, batches, description=None):
+        """Record a new run with the given lists of business ids as its batches, return the run id."""
+        now = time.time()
+        with self._lock:
+            cursor = self._connection.execute(
+                "INSERT INTO runs (description, started) VALUES (?, ?)", (description, now))
+            run_id = cursor.lastrowid
+            self._connection.executemany(
+                "INSERT INTO batches (run_id, seq, bids, state, updated) VALUES (?, ?, ?, ?, ?)",
+                ((run_id, seq, "\n".join(batch), PENDING, now) for seq, batch in enumerate(batches)))
+            self._connection.commit()
+        return run_id
+
+    def mark(self, run_id, seq, state):
+        with self._lock:
+            self._connection.execute(
+                "UPDATE batches SET state = ?, updated = ? WHERE run_id = ? AND seq = ?",
+                (state, time.time(), run_id, seq))
+            self._connection.commit()
+
+    def finish_run(self, run_id):
+        with self._lock:
+            self._connection.execute("UPDATE runs SET finished = ? WHERE run_id = ?", (time.time(), run_id))
+            self._connection.commit()
+
+    def unfinished_batches(self, run_id):
+        """Return (seq, bids) of the batches of a run that are not stored yet, in order."""
+        return list(self.iter_unfinished_batches(run_id))
+
+    def iter_unfinished_batches(self, run_id, chunk_size=READ_CHUNK_SIZE):
+        """Yield (seq, bids) of the batches of a run that are not stored yet, reading a chunk at a time."""
+        last_seq = -1
+        while True:
+            with self._lock:
+                rows = self._connection.execute(
+                    "SELECT seq, bids FROM batches WHERE run_id = ? AND state != ? AND seq > ? ORDER BY seq LIMIT ?",
+                    (run_id, STORED, last_seq, chunk_size)).fetchall()
+            if not rows:
+                return
+            for seq, bids in rows:
+                yield seq, bids.split("\n")
+            last_seq = rows[-1][0]
+
+    def unfinished_count(self, run_id):
+        """Return the number of business ids in the batches of a run that are not stored yet."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT COALESCE(SUM(LENGTH(bids) - LENGTH(REPLACE(bids, char(10), '')) + 1), 0) "
+                "FROM batches WHERE run_id = ? AND state != ?", (run_id, STORED)).fetchone()
+        return row[0]
+
+    def last_unfinished_run(self):
+        """Return the id of the latest run that did not finish, or None."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT MAX(run_id) FROM runs WHERE finished IS NULL").fetchone()
+        return row[0]
+
+    def progress(self, run_id):
+        """Return the number of batches of a run in each state."""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT state, COUNT(*) FROM batches WHERE run_id = ? GROUP BY state", (run_id,)).fetchall()
+        counts = {state: 0 for state in (PENDING, FETCHED, PARSED, STORED)}
+        counts.update(rows)
+        return counts
@@ -0,0 +1,80 @@
+"""
+Timers and counters for the stages of the YTJ pipeline.
+
+YtjClient records the SOAP latency per operation, the serialization and parsing time,
+the database time per table and the retries into a PipelineMetrics object, which can
+be turned into a summary dict, a table for display or a JSON file.
+"""
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+from db_api.histogram import Histogram
+
+# Upper bounds of the latency histogram buckets (seconds), the last bucket is open
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class PipelineMetrics:
+    """
+    Thread-safe timers and counters of one pipeline run.
+
+    Timers are histograms under a (stage, key) name, e.g. ("soap", "wmToiminimi") or
+    ("db", "companies"). Counters are plain numbers under the same kind of names.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.timers = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, key, seconds):
+        with self._lock:
+            histogram = self.timers.get((stage, key))
+            if histogram is None:
+                histogram = self.timers[(stage, key)] = Histogram(LATENCY_BUCKETS)
+            histogram.observe(seconds)
+
+    def count(self, stage, key, n=1):
+        with self._lock:
+            self.counters[(stage, key)] = self.counters.get((stage, key), 0) + n
+
+    @contextmanager
+    def timer(self, stage, key):
+        """Time the block under (stage, key), also when it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, key, time.perf_counter() - started)
+
+    def summary(self):
+        """Return the metrics as a dict of stages, with the rates derived from them."""
+        with self._lock:
+            timers = {name: histogram.as_dict() for name, histogram in self.timers.items()}
+            counters = dict(self.counters)
+
+        out = {"elapsed": round(time.time() - self.started, 3)}
+        for (stage, key), values in timers.items():
+            out.setdefault(stage, {}).setdefault(key, {}).update(values)
+        for (stage, key), value in counters.items():
+            out.setdefault(stage, {}).setdefault(key, {})["total"] = value
+
+        parse = out.get("parse", {}).get("companies")
+        if parse and parse.get("seconds"):
+            parse["per_second"] = round(parse.get("total", 0) / parse["seconds"], 1)
+        return out
+
+    def rows(self):
+        """Return one row per timer for a table: stage, key, count, seconds and percentiles."""
+        with self._lock:
+            items = sorted(self.timers.items())
+        return [{"stage": stage, "key": key, "count": histogram.count, "seconds": round(histogram.total, 3),
+                 "p50": histogram.percentile(50), "p95": histogram.percentile(95), "max": histogram.max}
+                for (stage, key), histogram in items]
+
+    def save(self, path, **extra):
+        """Write the summary, and any extra values such as the run summary, to a JSON file."""
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(dict(extra, metrics=self.summary()), f, indent=2, default=str)
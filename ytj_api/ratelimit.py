@@ -0,0 +1,47 @@
+import time
+import threading
+
+class TokenBucket:
+    """
+    Thread-safe token bucket limiting the rate of API calls.
+
+    Tokens are added at `rate` per second up to `burst`, and every call takes one. One
+    bucket can be shared by several YtjClients, e.g. by the concurrent jobs of a
+    JobRunner, so that together they stay under the API limit.
+    """
+
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError("rate must be positive.")
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, n=1):
+        """Take n tokens if they are available, return True if they were taken."""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= n:
+                self._tokens -= n
+                return True
+            return False
+
+    def acquire(self, n=1):
+        """Take n tokens, waiting until they are available. Returns the seconds waited."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= n:
+                    self._tokens -= n
+                    return waited
+                delay = (n - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
@@ -0,0 +1,137 @@
+"""
+Record types for parsed YTJ company data.
+
+CompanyRecord holds one parsed company and CompanyBatch holds many of them as parallel
+column lists, so the storage layer can bind whole columns at once.
+"""
+
+import json
+import hashlib
+
+# Fields stored in the companies table, in the order of ytj.COMPANY_COLUMNS (without checked)
+CORE_FIELDS = ('business_id', 'company', 'company_form', 'main_industry', 'postal_code',
+               'company_registration_date', 'status', 'hq')
+
+# Lists of (name, start_date, end_date) tuples and (old id, new id, date, description) tuples
+LIST_FIELDS = ('trade_names', 'secondary_names', 'previous_names', 'business_id_events')
+
+FIELDS = CORE_FIELDS + LIST_FIELDS
+
+# Fields covered by the content fingerprint. Previous names are left out, they come from
+# a separate wmToiminimi call that may be skipped, and only change with the company name.
+FINGERPRINT_FIELDS = CORE_FIELDS + ('trade_names', 'secondary_names', 'business_id_events')
+
+def _fingerprint(content):
+    serialized = json.dumps(list(content), ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha1(serialized.encode("utf-8")).hexdigest()
+
+class CompanyRecord:
+    """One parsed company, as returned by YtjClient.parse_company."""
+
+    __slots__ = FIELDS
+
+    def __init__(self, business_id, company, company_form, main_industry, postal_code,
+                 company_registration_date, status, hq, trade_names=None, secondary_names=None,
+                 previous_names=None, business_id_events=None):
+        self.business_id = business_id
+        self.company = company
+        self.company_form = company_form
+        self.main_industry = main_industry
+        self.postal_code = postal_code
+        self.company_registration_date = company_registration_date
+        self.status = status
+        self.hq = hq
+        self.trade_names = trade_names if trade_names is not None else []
+        self.secondary_names = secondary_names if secondary_names is not None else []
+        self.previous_names = previous_names if previous_names is not None else []
+        self.business_id_events = business_id_events if business_id_events is not None else []
+
+    def core_values(self):
+        """Return the values of the companies table columns as a list."""
+        return [getattr(self, field) for field in CORE_FIELDS]
+
+    def fingerprint(self):
+        """Return a stable SHA-1 hex digest of the company content, see FINGERPRINT_FIELDS."""
+        return _fingerprint([getattr(self, field) for field in FINGERPRINT_FIELDS])
+
+    def as_tuple(self):
+        return tuple(getattr(self, field) for field in FIELDS)
+
+    def __eq__(self, other):
+        if not isinstance(other, CompanyRecord):
+            return NotImplemented
+        return self.as_tuple() == other.as_tuple()
+
+    def __repr__(self):
+        values = ", ".join(f"{field}={getattr(self, field)!r}" for field in FIELDS)
+        return f"CompanyRecord({values})"
+
+class CompanyBatch:
+    """Many parsed companies stored column-wise, one list per field."""
+
+    __slots__ = FIELDS
+
+    def __init__(self, records=()):
+        for field in FIELDS:
+            setattr(self, field, [])
+        for record in records:
+            self.append(record)
+
+    def append(self, record):
+        for field in FIELDS:
+            getattr(self, field).append(getattr(record, field))
+
+    def __len__(self):
+        return len(self.business_id)
+
+    def __getitem__(self, i):
+        return CompanyRecord(*(getattr(self, field)[i] for field in FIELDS))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def subset(self, indices):
+        """Return a new batch with the companies at the given positions."""
+        batch = CompanyBatch()
+        for field in FIELDS:
+            values = getattr(self, field)
+            setattr(batch, field, [values[i] for i in indices])
+        return batch
+
+    def latest(self):
+        """Return the batch with only the last company of each repeated business id, or the batch itself."""
+        last = {bid: i for i, bid in enumerate(self.business_id)}
+        if len(last) == len(self):
+            return self
+        return self.subset(sorted(last.values()))
+
+    def fingerprints(self):
+        """Return the fingerprints of the companies, computed from the columns."""
+        return [_fingerprint(content) for content in zip(*(getattr(self, field) for field in FINGERPRINT_FIELDS))]
+
+    def core_columns(self, columns, checked):
+        """
+        Return the companies table values as a {column: list of values} dict, for binding.
+
+        `columns` are the table columns, the core fields followed by the checked date.
+        """
+        values = [getattr(self, field) for field in CORE_FIELDS] + [[checked] * len(self)]
+        return dict(zip(columns, values))
+
+    def name_columns(self, field, name_field):
+        """Return the columns of a names table (trade_names etc.) for the companies that have names."""
+        data = {"business_id": [], name_field: [], "start_date": [], "end_date": []}
+        for business_id, names in zip(self.business_id, getattr(self, field)):
+            for name in names:
+                data["business_id"].append(business_id)
+                data[name_field].append(name[0])
+                data["start_date"].append(name[1])
+                data["end_date"].append(name[2])
+        return data
+
+    def event_columns(self):
+        """Return the columns of the business_id_events table."""
+        columns = ("business_id_old", "business_id_new", "event_date", "event_desc")
+        events = [event for company_events in self.business_id_events for event in company_events]
+        return {column: [event[i] for event in events] for i, column in enumerate(columns)}
@@ -0,0 +1,105 @@
+"""
+Re-check scheduler for companies already in the database.
+
+Picks the business ids to fetch again from YTJ within a budget of API calls per run,
+so that the whole companies table is kept fresh at a steady cost. Companies are ranked
+by how long ago they were checked, weighted by their status and company form.
+"""
+import heapq
+from datetime import date, datetime
+
+from ytj_api.ytj import MAX_BATCH_SIZE, PREVIOUS_NAME_FORMS
+
+# Companies checked within this many days are not re-checked
+DEFAULT_MIN_AGE = 30
+
+# Staleness in days given to companies that have never been checked
+NEVER_CHECKED_AGE = 10 * 365
+
+# Weight of the staleness by company status, active companies change the most
+STATUS_WEIGHTS = {
+    "Aktiivinen": 1.0,
+}
+DEFAULT_STATUS_WEIGHT = 0.2  # Ended, merged, bankrupt etc.
+
+# Weight of the staleness by company form, limited companies change the most
+FORM_WEIGHTS = {
+    "Osakeyhtiö": 1.0,
+    "Julkinen osakeyhtiö": 1.0,
+    "Osuuskunta": 0.8,
+    "Kommandiittiyhtiö": 0.6,
+    "Avoin yhtiö": 0.6,
+    "Yksityinen elinkeinonharjoittaja": 0.5,
+}
+DEFAULT_FORM_WEIGHT = 0.4
+
+def call_cost(company_form):
+    """API calls needed for one company besides its share of the batch call."""
+    return 1 if company_form in PREVIOUS_NAME_FORMS else 0
+
+class RecheckScheduler:
+    """
+    Plans which stored companies to re-fetch within a per-run API call budget.
+
+    A run costs one wmYritysTiedotMassahaku call per MAX_BATCH_SIZE ids plus one
+    wmToiminimi call per company whose previous names are fetched (see PREVIOUS_NAME_FORMS).
+    """
+
+    def __init__(self, db_client, min_age=DEFAULT_MIN_AGE, status_weights=None, form_weights=None):
+        self.db_client = db_client
+        self.min_age = min_age
+        self.status_weights = status_weights or STATUS_WEIGHTS
+        self.form_weights = form_weights or FORM_WEIGHTS
+
+    def priority(self, checked, status, company_form, today=None):
+        """Return the re-check priority of a company, its weighted staleness in days."""
+        today = today or date.today()
+        if checked is None:
+            age = NEVER_CHECKED_AGE
+        else:
+            if isinstance(checked, str):
+                checked = datetime.strptime(checked[:10], "%Y-%m-%d").date()
+            elif isinstance(checked, datetime):
+                checked = checked.date()
+            age = (today - checked).days
+        return age * self.status_weights.get(status, DEFAULT_STATUS_WEIGHT) \
+            * self.form_weights.get(company_form, DEFAULT_FORM_WEIGHT)
+
+    def _candidates(self, db):
+        """Yield (business_id, checked, status, company_form) of the companies old enough to re-check."""
+        cutoff = date.fromordinal(date.today().toordinal() - self.min_age).strftime('%Y-%m-%d')
+        # Streamed in chunks, plan keeps only the best max_ids rows of them
+        for row in db.iter_query("SELECT business_id, checked, status, company_form FROM companies "
+                                 "WHERE checked IS NULL OR checked < :cutoff", {"cutoff": cutoff}):
+            yield tuple(row)
+
+    def plan(self, budget):
+        """
+        Return (bids, calls) where bids are the companies to re-check in priority order
+        and calls is the estimated number of API calls they take, at most `budget`.
+        """
+        if budget < 1:
+            return [], 0
+
+        # Every id costs at least its share of a batch call, so this bounds the selection
+        today = date.today()
+        max_ids = budget * MAX_BATCH_SIZE
+        with self.db_client as db:
+            ranked = heapq.nlargest(
+                max_ids, self._candidates(db),
+                key=lambda row: self.priority(row[1], row[2], row[3], today))
+
+        bids = []
+        calls = 0
+        for business_id, _, _, company_form in ranked:
+            cost = call_cost(company_form)
+            if len(bids) % MAX_BATCH_SIZE == 0:
+                cost += 1  # Starts a new batch
+            if calls + cost > budget:
+                # A cheaper company further down may still fit
+                continue
+            bids.append(business_id)
+            calls += cost
+            if calls == budget and len(bids) % MAX_BATCH_SIZE == 0:
+                break
+        return bids, calls
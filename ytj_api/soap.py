@@ -0,0 +1,74 @@
+"""
+Process-wide zeep clients for the YTJ SOAP service.
+
+Parsing the WSDL takes a noticeable part of a YtjClient construction, so the parsed
+zeep client is built once per WSDL and shared by every YtjClient of the process, also
+between Streamlit reruns. The clients send their requests through one pooled
+requests.Session with keep-alive connections and timeouts. zeep and requests are only
+imported when the first client is built.
+"""
+import os
+import threading
+
+# The bundled WSDL, in the same dir as this script
+DEFAULT_WSDL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 "https_api_tietopalvelu_ytj_fi_yritystiedot.wsdl")
+
+# Timeout for loading the WSDL and the schemas it imports (seconds)
+LOAD_TIMEOUT = 30
+
+# Timeout for one SOAP operation, a full batch of 195 companies can take a while (seconds)
+OPERATION_TIMEOUT = 120
+
+# Max keep-alive connections per host, enough for the fetch and previous name workers
+POOL_SIZE = 16
+
+# Imported schemas are cached in memory for this long (seconds)
+SCHEMA_CACHE_TIMEOUT = 24 * 60 * 60
+
+_lock = threading.Lock()
+_clients = {}
+_session = None
+
+def get_session():
+    """Return the shared requests.Session used by all the clients."""
+    global _session
+    with _lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            # Retries are done by YtjClient, which knows which requests are safe to repeat
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=0)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+        return _session
+
+def get_client(wsdl_url=None):
+    """Return the shared zeep.Client for a WSDL, building it on first use."""
+    wsdl_url = wsdl_url or DEFAULT_WSDL_PATH
+    client = _clients.get(wsdl_url)
+    if client is not None:
+        return client
+
+    from zeep import Client
+    from zeep.cache import InMemoryCache
+    from zeep.transports import Transport
+
+    transport = Transport(session=get_session(), cache=InMemoryCache(timeout=SCHEMA_CACHE_TIMEOUT),
+                          timeout=LOAD_TIMEOUT, operation_timeout=OPERATION_TIMEOUT)
+    client = Client(wsdl_url, transport=transport)
+    with _lock:
+        # Another thread may have built it meanwhile, keep the first one
+        return _clients.setdefault(wsdl_url, client)
+
+def create_service(client, address):
+    """Return a service proxy with the binding of the client's default service and another address."""
+    return client.create_service(client.service._binding.name, address)
+
+def clear():
+    """Drop the shared clients, e.g. after the WSDL file has changed."""
+    with _lock:
+        _clients.clear()
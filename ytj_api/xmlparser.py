@@ -0,0 +1,232 @@
+"""
+Fast parser for raw YTJ SOAP responses.
+
+Parses the wmYritysTiedotMassahaku and wmToiminimi response XML directly with lxml,
+without building zeep objects and serializing them to OrderedDicts. The records have
+the same content as YtjClient.parse_company and YtjClient._fetch_previous_names return,
+YtjClient.check_fast_parser compares the two paths.
+"""
+import io
+from datetime import datetime
+from functools import lru_cache
+
+from lxml import etree
+
+from ytj_api.records import CompanyRecord
+
+_XSI_NIL = "{http://www.w3.org/2001/XMLSchema-instance}nil"
+
+# Same formats as in YtjClient.format_date
+_DATE_FORMATS = (
+    "%d.%m.%Y %H:%M:%S",  # Format with time (e.g., "23.4.2019 11:52:05")
+    "%d.%m.%Y",           # Format without time (e.g., "08.11.2000")
+)
+
+@lru_cache(maxsize=65536)
+def format_date(date_str):
+    """Same as YtjClient.format_date, cached since the same dates repeat a lot."""
+    if not date_str:
+        return None
+    for fmt in _DATE_FORMATS:
+        try:
+            return datetime.strptime(date_str, fmt).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    return None
+
+def _localname(elem):
+    return elem.tag.rpartition("}")[2]
+
+def _is_nil(elem):
+    return elem.get(_XSI_NIL) in ("true", "1")
+
+def _children(elem):
+    """Return a {local name: [child elements]} dict of the children of `elem`."""
+    out = {}
+    if elem is None:
+        return out
+    for child in elem:
+        if isinstance(child.tag, str):
+            out.setdefault(_localname(child), []).append(child)
+    return out
+
+def _is_present(elem):
+    """
+    Tell if a complex element has a value the way zeep sees it.
+
+    zeep returns None for a complex element without child elements, but an object with
+    all fields set to None for an element with xsi:nil.
+    """
+    return _is_nil(elem) or len(elem) > 0
+
+def _first(children, name):
+    """First child called `name` if it is a present complex element, else None."""
+    elems = children.get(name)
+    return elems[0] if elems and _is_present(elems[0]) else None
+
+def _items(elem, name):
+    """The present complex children called `name` of `elem`, like the items of a zeep list."""
+    if elem is None:
+        return []
+    return [item for item in _children(elem).get(name, []) if _is_present(item)]
+
+def _text(children, name):
+    """Text of the first child called `name`, None if it is missing, nil or empty like zeep."""
+    elems = children.get(name)
+    return elems[0].text if elems else None
+
+def _names(children, key):
+    """Same as YtjClient.extract_names."""
+    container = _first(children, key)
+    if container is None:
+        return []
+    names = []
+    for item in _items(container, "ToiminimiDTO"):
+        item_children = _children(item)
+        names.append((_text(item_children, "Toiminimi"),
+                      format_date(_text(item_children, "AlkuPvm")),
+                      format_date(_text(item_children, "LoppuPvm"))))
+    return names
+
+def _business_id_events(children):
+    """Same as YtjClient.extract_business_id_events."""
+    history = _first(children, "YritystunnusHistoria")
+    if history is None:
+        return []
+    events = []
+    for event in _items(history, "YritysTunnusHistoriaDTO"):
+        event_children = _children(event)
+        events.append((_text(event_children, "YTunnusVanha"),
+                       _text(event_children, "YTunnusUusi"),
+                       format_date(_text(event_children, "Muutospvm")),
+                       _text(event_children, "Tapahtuma")))
+    return events
+
+def _registration_date(children, ytunnus):
+    """Same as YtjClient.get_registration_date."""
+    registration_date = _text(ytunnus, "Alkupvm")
+    if not registration_date:
+        history = _first(children, "YrityksenRekisteriHistoria")
+        for entry in _items(history, "YrityksenRekisteri"):
+            entry_children = _children(entry)
+            if _text(entry_children, "Rekisterikoodi") == "1":
+                registration_date = _text(entry_children, "Alkupvm")
+                break
+    return format_date(registration_date) if registration_date else None
+
+def parse_company_element(elem):
+    """
+    Parse one company element of a wmYritysTiedotMassahaku response.
+
+    Returns the same CompanyRecord as YtjClient.parse_company, or None for an invalid company.
+    """
+    children = _children(elem)
+    ytunnus_elem = _first(children, "YritysTunnus")
+    if ytunnus_elem is None:
+        return None
+    ytunnus = _children(ytunnus_elem)
+    businessid = _text(ytunnus, "YTunnus")
+    if not businessid:
+        return None
+
+    name = _text(_children(_first(children, "Toiminimi")), "Toiminimi")
+    if not name:
+        name = '[tyhjä]'
+        if _first(children, "YrityksenHenkilo") is not None:
+            name = _text(_children(_first(children, "YrityksenHenkilo")), "Nimi")
+
+    status = _text(ytunnus, "YrityksenLopettamisenSyy")
+    if _text(_children(_first(children, "ElinkeinoToiminta")), "Seloste") == "Elinkeinotoiminta päättynyt":
+        status = "Toiminta lakannut"
+    if not status:
+        status = "Aktiivinen"
+
+    businessline = None
+    if _first(children, "Toimiala") is not None:
+        toimiala = _children(_first(children, "Toimiala"))
+        businessline = f"{_text(toimiala, 'Seloste')} ({_text(toimiala, 'Koodi')})"
+
+    zipcode = None
+    if _first(children, "YrityksenPostiOsoite") is not None:
+        zipcode = _text(_children(_first(children, "YrityksenPostiOsoite")), "Postinumero")
+    if not zipcode and _first(children, "YrityksenKayntiOsoite") is not None:
+        zipcode = _text(_children(_first(children, "YrityksenKayntiOsoite")), "Postinumero")
+
+    hq = (_text(_children(_first(children, "Kotipaikka")), "Seloste") or '').title() or None
+    format = _text(_children(_first(children, "Yritysmuoto")), "Seloste") or "[Ei tiedossa]"
+
+    return CompanyRecord(businessid, name, format, businessline, zipcode,
+                         _registration_date(children, ytunnus), status, hq,
+                         _names(children, "Aputoiminimet"),
+                         _names(children, "Rinnakkaistoiminimet"),
+                         [],  # Previous names are filled in by YtjClient.enrich_previous_names
+                         _business_id_events(children))
+
+def iter_company_elements(xml):
+    """
+    Yield the company elements of a raw wmYritysTiedotMassahaku response.
+
+    The companies are the children of the wmYritysTiedotMassahakuResult element. Each
+    element is cleared after the consumer is done with it, so copy what is needed.
+    """
+    result_depth = None
+    depth = 0
+    for event, elem in etree.iterparse(io.BytesIO(xml), events=("start", "end")):
+        if event == "start":
+            depth += 1
+            if result_depth is None and _localname(elem) == "wmYritysTiedotMassahakuResult":
+                result_depth = depth
+            continue
+
+        if result_depth is not None and depth == result_depth + 1:
+            yield elem
+            elem.clear()
+            # Also drop the references from the parent to the already handled companies
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+        elif depth == result_depth:
+            result_depth = None
+        depth -= 1
+
+def company_bid(elem):
+    """Return the business id of a company element, or None."""
+    return _text(_children(_first(_children(elem), "YritysTunnus")), "YTunnus")
+
+def iter_company_fragments(xml):
+    """Yield (business id, company XML fragment) pairs of a raw wmYritysTiedotMassahaku response."""
+    for elem in iter_company_elements(xml):
+        yield company_bid(elem), etree.tostring(elem)
+
+def parse_company_xml(fragment):
+    """Parse a company XML fragment as yielded by iter_company_fragments."""
+    return parse_company_element(etree.fromstring(fragment))
+
+def parse_companies(xml):
+    """Parse all companies of a raw wmYritysTiedotMassahaku response, skipping invalid ones."""
+    records = []
+    for elem in iter_company_elements(xml):
+        record = parse_company_element(elem)
+        if record is not None:
+            records.append(record)
+    return records
+
+def parse_previous_names(xml):
+    """Parse a raw wmToiminimi response, same result as YtjClient._fetch_previous_names."""
+    root = etree.fromstring(xml)
+    result = None
+    for elem in root.iter():
+        if isinstance(elem.tag, str) and _localname(elem) == "wmToiminimiResult":
+            result = elem
+            break
+    if result is None or not _is_present(result):
+        return []
+
+    names = []
+    edellinen_tieto = _first(_children(result), "EdellinenTieto")
+    for item in _items(edellinen_tieto, "YTieto"):
+        item_children = _children(item)
+        name = _text(item_children, "Tieto")
+        if name:
+            names.append((name, format_date(_text(item_children, "Alkupvm")),
+                          format_date(_text(item_children, "Loppupvm"))))
+    return names
@@ -1,40 +1,205 @@
+import io
 import os
-import re
 import hashlib
-import numpy as np
 import pprint
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing
 from datetime import datetime
+from functools import lru_cache
+from itertools import islice
 from dotenv import load_dotenv
-from zeep import Client, helpers
-from sqlalchemy.sql import text
+# zeep, requests, numpy, lxml and sqlalchemy are imported on first use, so that importing
+# this module stays fast. See ipr/startup_timing.py.
+from db_api import stats as db_stats
+from ytj_api import journal as runjournal, soap
+from ytj_api.metrics import PipelineMetrics
+from ytj_api.batching import AdaptiveBatchSize, FetchStats, MAX_ATTEMPTS, MAX_SPLITS, FAULT_PROBES, backoff_delay
+from ytj_api.records import CompanyRecord, CompanyBatch
 from datetime import datetime
 
-# Constants for data indices
-BUSINESS_ID = 0
-TRADE_NAMES = 8
-SECONDARY_NAMES = 9
-PREVIOUS_NAMES = 10
-EVENTS = 11
+# YTJ API has a limit of 200 bids per query, to be safe we are limiting to 195
+MAX_BATCH_SIZE = 195
+
+# Number of wmYritysTiedotMassahaku batches kept in flight by get_multiple
+DEFAULT_WORKERS = 4
+
+# Company forms whose previous names are fetched with wmToiminimi
+PREVIOUS_NAME_FORMS = ('Osakeyhtiö', 'Julkinen osakeyhtiö')
+
+# Max number of bind parameters used in one IN (...) lookup
+LOOKUP_CHUNK_SIZE = 1000
+
+# Number of parsed batches buffered between the parse and store stages of run_pipeline
+DEFAULT_QUEUE_SIZE = 2
+
+# Statement shapes added to the run summary when the database engine is instrumented
+SQL_REPORT_TOP = 10
+
+# Operation names used as cache keys
+OP_COMPANIES = "wmYritysTiedotMassahaku"
+OP_PREVIOUS_NAMES = "wmToiminimi"
+
+# Cache keys of the raw XML responses used by the fast parser
+OP_COMPANIES_XML = OP_COMPANIES + ".xml"
+OP_PREVIOUS_NAMES_XML = OP_PREVIOUS_NAMES + ".xml"
+
+# Marks a cache miss, None is a valid cached value
+_MISSING = object()
+
+# Tables replaced by the store methods: (table, CompanyRecord field, name column)
+NAME_TABLES = [
+    ("trade_names", "trade_names", "trade_name"),
+    ("secondary_names", "secondary_names", "secondary_name"),
+    ("previous_names", "previous_names", "previous_name"),
+]
+
+# Columns of the companies table written by the store methods
+COMPANY_COLUMNS = ['business_id', 'company', 'company_form', 'main_industry', 'postal_code',
+                   'company_registration_date', 'status', 'hq', 'checked']
 
 # Load the environment variables from the .env file
 load_dotenv(".env")
 CUSTOMER_NAME = os.getenv("CUSTOMER_NAME")
 API_KEY = os.getenv("API_KEY")
 
+@lru_cache(maxsize=None)
+def _fetch_errors():
+    """
+    Return the (transient, all) exception types of a batch request.
+
+    Transient errors are worth retrying: timeouts, connection errors and HTTP errors.
+    All of them are handled by splitting the batch, e.g. SOAP faults.
+    """
+    import requests
+    from zeep.exceptions import Error as ZeepError, TransportError
+    from lxml.etree import XMLSyntaxError
+
+    transient = (requests.exceptions.RequestException, TransportError)
+    return transient, transient + (ZeepError, XMLSyntaxError)
+
+def _fault_key(error):
+    """Identify a fetch error by its type and message, to tell whether two requests failed the same way."""
+    return type(error), str(error)
+
+def _serialize(obj):
+    """Serialize a zeep object to OrderedDicts and lists."""
+    from zeep import helpers
+    return helpers.serialize_object(obj)
+
+def _chunked(iterable, size):
+    """Yield lists of at most `size` items from any iterable."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _prefetch(iterable, maxsize):
+    """
+    Run an iterable in a background thread and yield its items through a bounded queue.
+
+    The producer blocks when `maxsize` items are waiting, which gives backpressure to the
+    earlier stages. Exceptions from the producer are re-raised in the consumer.
+    """
+    items = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Returns False if the consumer has stopped
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    # Close the earlier stages too, e.g. to shut down their thread pools
+                    if hasattr(iterable, "close"):
+                        iterable.close()
+                    return
+            put((True, done))
+        except BaseException as e:
+            put((False, e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            ok, item = items.get()
+            if not ok:
+                raise item
+            if item is done:
+                return
+            yield item
+    finally:
+        # Consumer stopped early or failed, let the producer thread finish
+        stop.set()
+        thread.join()
+
 class YtjClient:
-    def __init__(self, wsdl_url = None):
-        # If no custom WSDL URL is provided, use the one in the same dir as this script
-        if wsdl_url is None:
-            script_dir = os.path.dirname(os.path.abspath(__file__))
-            wsdl_url = os.path.join(script_dir, "https_api_tietopalvelu_ytj_fi_yritystiedot.wsdl")
-        
-        self.client = Client(wsdl_url)
+    def __init__(self, wsdl_url = None, cache=None, cache_only=False, fast_parse=False, address=None):
+        # If no custom WSDL URL is provided, use the one in the same dir as this script.
+        # The parsed client and its connection pool are shared within the process.
+        self.client = soap.get_client(wsdl_url)
+        # The service address can be overridden, e.g. with the one of a ytj_api.fakeytj.FakeYtjService
+        self.service = self.client.service if address is None else soap.create_service(self.client, address)
         self.db_client = None  # Initially, no database client is set
+        self.bid_index = None  # Optional ytj_api.bidindex.BidIndex of already known ids
+        # Parse the raw response XML with ytj_api.xmlparser instead of going through zeep objects
+        self.fast_parse = fast_parse
+        # Size of the wmYritysTiedotMassahaku requests, follows the latency and errors
+        self.batch_size = AdaptiveBatchSize(MAX_BATCH_SIZE)
+        self.fetch_stats = FetchStats()
+        # Stage timers and counters, reset by run_pipeline
+        self.metrics = PipelineMetrics()
+        # Optional ytj_api.ratelimit.TokenBucket, taken from before every API call
+        self.rate_limiter = None
+        # Keep the db_api.stats statistics up to date when storing batches
+        self.update_stats = True
+        self.set_cache(cache, cache_only)
 
     def set_database(self, db_client):
         """Set the database client."""
         self.db_client = db_client
 
+    def set_bid_index(self, bid_index):
+        """Set a BidIndex, generate_bids then skips ids that are already known."""
+        self.bid_index = bid_index
+
+    def set_rate_limiter(self, rate_limiter):
+        """Set a TokenBucket limiting the API calls, it can be shared with other clients."""
+        self.rate_limiter = rate_limiter
+
+    def _throttle(self):
+        """Wait for the rate limiter, if any, before an API call."""
+        if self.rate_limiter is not None:
+            waited = self.rate_limiter.acquire()
+            if waited:
+                self.metrics.observe("wait", "rate_limit", waited)
+
+    def set_cache(self, cache, cache_only=False):
+        """
+        Set a response cache (see ytj_api.cache.ResponseCache), or None to disable caching.
+
+        With cache_only, ids missing from the cache are treated as if YTJ returned nothing
+        for them, so cached runs can be re-parsed and re-stored without network access.
+        """
+        if cache_only and cache is None:
+            raise ValueError("cache_only requires a cache.")
+        self.cache = cache
+        self.cache_only = cache_only
+
     def _get_timestamp_and_token(self):
         """Fetch the timestamp and token required for the paid YTJ API access"""
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -42,6 +207,16 @@ class YtjClient:
         sha1_token = hashlib.sha1(input_string.encode()).hexdigest()
         return timestamp, sha1_token
 
+    def _request_raw(self, operation, params):
+        """Call an operation and return the raw response XML, raising SOAP faults like zeep does."""
+        self._throttle()
+        with self.client.settings(raw_response=True), self.metrics.timer("soap", operation):
+            response = getattr(self.service, operation)(**params)
+        if response.status_code != 200:
+            binding = self.service._binding
+            binding.process_reply(self.client, binding._operations[operation], response)
+        return response.content
+
     def _fetch_previous_names(self, bid):
         """Fetch previous names for a given business ID using wmToiminimi."""
         timestamp, token = self._get_timestamp_and_token()
@@ -53,11 +228,38 @@ class YtjClient:
             "tiketti": "",
             "kieli": "fi"
         }
+        operation = OP_PREVIOUS_NAMES_XML if self.fast_parse else OP_PREVIOUS_NAMES
+
+        serialized_response = _MISSING
+        if self.cache is not None:
+            serialized_response = self.cache.get(operation, bid, _MISSING)
+
+        if serialized_response is _MISSING:
+            if self.cache_only:
+                return []
+
+            # Call the service
+            if self.fast_parse:
+                serialized_response = self._request_raw(OP_PREVIOUS_NAMES, params)
+            else:
+                self._throttle()
+                with self.metrics.timer("soap", OP_PREVIOUS_NAMES):
+                    response = self.service.wmToiminimi(**params)
+                with self.metrics.timer("parse", "serialize"):
+                    serialized_response = _serialize(response)
+            if self.cache is not None:
+                self.cache.put(operation, bid, serialized_response)
+
+        if not serialized_response:
+            return []
 
-        # Call the service
-        response = self.client.service.wmToiminimi(**params)
-        serialized_response = helpers.serialize_object(response)
+        if self.fast_parse:
+            from ytj_api import xmlparser
+            return xmlparser.parse_previous_names(serialized_response)
+        return self._parse_previous_names(serialized_response)
 
+    def _parse_previous_names(self, serialized_response):
+        """Extract the previous names from a serialized wmToiminimi response."""
         # If no EdellinenTieto → nothing to do
         edellinen_tieto = serialized_response.get("EdellinenTieto")
         if not edellinen_tieto:
@@ -87,7 +289,7 @@ class YtjClient:
 
     def debug_pretty_print_company(self, company):
         # Serialize the company object
-        data = helpers.serialize_object(company)
+        data = _serialize(company)
 
         # Pretty print the serialized data
         pp = pprint.PrettyPrinter(indent=2, width=120, compact=False)
@@ -95,31 +297,304 @@ class YtjClient:
 
         return 
 
-    def get_multiple(self, bids, progbar):
-        out = []
+    @staticmethod
+    def _company_bid(company):
+        """Return the business id of a serialized company, or None."""
+        ytunnus_info = company.get('YritysTunnus') if isinstance(company, dict) else None
+        return ytunnus_info.get('YTunnus') if isinstance(ytunnus_info, dict) else None
+
+    def _fetch_batch(self, batch):
+        """Fetch one batch of companies, from the cache when one is set."""
+        if self.cache is None:
+            if self.fast_parse:
+                return [fragment for _, fragment in self._request_companies(batch)]
+            return self._request_batch(batch)
+
+        operation = OP_COMPANIES_XML if self.fast_parse else OP_COMPANIES
+        cached = self.cache.get_many(operation, batch)
+        missing = [bid for bid in batch if bid not in cached]
+        extra = []
+
+        if missing and not self.cache_only:
+            requested = set(missing)
+            fetched = {}
+            for bid, company in self._request_companies(missing):
+                if bid in requested:
+                    fetched[bid] = company
+                else:
+                    # YTJ returned a company under another id than the ones asked for
+                    extra.append((bid, company))
+
+            # Ids without a company are cached as empty, unless some of the returned
+            # companies could not be matched to the requested ids
+            if not extra:
+                fetched.update({bid: None for bid in missing if bid not in fetched})
+
+            self.cache.put_many(operation, list(fetched.items()) + [item for item in extra if item[0]])
+            cached.update(fetched)
+
+        companies = [cached[bid] for bid in batch if cached.get(bid) is not None]
+        return companies + [company for _, company in extra]
+
+    def _fetch_with_retries(self, batch):
+        """Fetch one batch, retrying transient errors with exponential backoff and jitter."""
+        transient_errors, fetch_errors = _fetch_errors()
+        for attempt in range(MAX_ATTEMPTS):
+            started = time.monotonic()
+            try:
+                companies = self._fetch_batch(batch)
+            except fetch_errors as e:
+                # Only transient errors say something about the load, a fault is about the ids
+                if not isinstance(e, transient_errors):
+                    raise
+                self.batch_size.record(time.monotonic() - started, ok=False)
+                if attempt == MAX_ATTEMPTS - 1:
+                    raise
+                self.fetch_stats.add_retry()
+                self.metrics.count("fetch", "retries")
+                time.sleep(backoff_delay(attempt))
+                continue
+            self.batch_size.record(time.monotonic() - started)
+            return companies
 
-        # YTJ API has a limit of 200 bids per query, to be safe we are limiting to 195
-        maxsize = min(195, len(bids))
-        
-        batches = np.array_split(bids, np.ceil(len(bids) / maxsize))
+    def _isolate_failure(self, batch, error, probe=True):
+        """
+        Split a failed batch in half until the failing ids are found, return the other companies.
+
+        Raises RuntimeError instead if the failure is not about the ids: when both halves
+        fail with transient errors (the service is down), when single probed ids get the
+        same fault as the batch (e.g. a bad or expired API key), or when the run has made
+        MAX_SPLITS splits.
+        """
+        if len(batch) == 1:
+            self.fetch_stats.add_failure(batch[0], error)
+            self.metrics.count("fetch", "failed_bids")
+            print(f"Skipping business id {batch[0]}: {error}")
+            return []
+
+        companies = []
+        if probe:
+            probed, companies = self._probe_fault(batch, error)
+            batch = batch[probed:]
+            if not batch:
+                return companies
+
+        transient_errors, fetch_errors = _fetch_errors()
+        if self.fetch_stats.splits >= MAX_SPLITS:
+            raise RuntimeError(f"Error fetching companies, {MAX_SPLITS} failing requests split: {error}")
+        self.fetch_stats.add_split()
+        self.metrics.count("fetch", "splits")
+        mid = len(batch) // 2
+        failed = []
+        for half in (batch[:mid], batch[mid:]):
+            try:
+                companies += self._fetch_with_retries(half)
+            except fetch_errors as e:
+                failed.append((half, e))
+
+        # Both halves failing after retries means that the service is down, not that an id is bad
+        if len(failed) == 2 and all(isinstance(e, transient_errors) for _, e in failed):
+            raise RuntimeError(f"Error fetching companies: {error}")
+
+        # Both halves getting the same fault may be a fault of every request, probe again
+        same_fault = len(failed) == 2 and _fault_key(failed[0][1]) == _fault_key(failed[1][1])
+        for half, e in failed:
+            companies += self._isolate_failure(half, e, probe=same_fault)
+            same_fault = False
+        return companies
+
+    def _probe_fault(self, batch, error):
+        """
+        Fetch the first FAULT_PROBES ids of a failed batch one at a time.
+
+        Raises RuntimeError if all of them fail with the fault of the batch, or with a
+        transient error: splitting would then only repeat the failure for every id.
+        Returns the number of ids probed and their companies.
+        """
+        transient_errors, fetch_errors = _fetch_errors()
+        failed = []
+        for i, bid in enumerate(batch[:FAULT_PROBES]):
+            try:
+                companies = self._fetch_with_retries([bid])
+            except fetch_errors as e:
+                failed.append((bid, e))
+                if isinstance(e, transient_errors) or _fault_key(e) == _fault_key(error):
+                    continue
+                companies = []  # A fault of its own, the id is bad
+            # The service answers single ids, so the ids that failed before this one are bad
+            for failed_bid, e in failed:
+                self._isolate_failure([failed_bid], e)
+            return i + 1, companies
+        raise RuntimeError(f"Error fetching companies, single ids fail too: {failed[-1][1]}")
+
+    def _fetch_batch_safe(self, batch):
+        """
+        Fetch one batch in requests of the adaptive batch size.
+
+        Transient errors are retried, and a request that still fails is split in half
+        recursively so that only the failing ids are lost. They are recorded in fetch_stats.
+        """
+        _, fetch_errors = _fetch_errors()
+        companies = []
+        for chunk in _chunked(batch, self.batch_size.size):
+            try:
+                companies += self._fetch_with_retries(chunk)
+            except fetch_errors as e:
+                companies += self._isolate_failure(chunk, e)
+        return companies
+
+    def _request_companies(self, batch):
+        """Fetch one batch and return (business id, company) pairs in a cacheable form."""
+        if self.fast_parse:
+            from ytj_api import xmlparser
+            return list(xmlparser.iter_company_fragments(self._request_raw(OP_COMPANIES, self._batch_params(batch))))
+
+        response = self._request_batch(batch)
+        with self.metrics.timer("parse", "serialize"):
+            companies = [_serialize(company) for company in response]
+        return [(self._company_bid(company), company) for company in companies]
+
+    def _batch_params(self, batch):
+        # Every call gets its own timestamp and token, also when run in a worker thread
+        timestamp, token = self._get_timestamp_and_token()
+        return {
+            "ytunnus": ";".join(batch),
+            "kieli": "fi",
+            "asiakastunnus": CUSTOMER_NAME,
+            "aikaleima": timestamp,
+            "tarkiste": token,
+            "tiketti": ""
+        }
+
+    def _request_batch(self, batch):
+        """Fetch one batch of companies with wmYritysTiedotMassahaku."""
+        self._throttle()
+        with self.metrics.timer("soap", OP_COMPANIES):
+            return self.service.wmYritysTiedotMassahaku(**self._batch_params(batch)) or []
+
+    def check_fast_parser(self, bids, previous_names=True):
+        """
+        Check that the fast XML parser and parse_company give identical results.
+
+        Each batch is fetched once as raw XML, which is then parsed both with zeep and with
+        ytj_api.xmlparser. With previous_names, the wmToiminimi responses of the companies
+        that need them are compared too. Returns a list of (business id, zeep result, fast
+        result) tuples of the differences, an empty list means the paths agree.
+        """
+        import requests
+        from ytj_api import xmlparser
+
+        binding = self.service._binding
+        differences = []
+
+        def zeep_reply(operation, xml):
+            response = requests.Response()
+            response.status_code = 200
+            response._content = xml
+            return binding.process_reply(self.client, binding._operations[operation], response)
+
+        for batch in _chunked(bids, MAX_BATCH_SIZE):
+            xml = self._request_raw(OP_COMPANIES, self._batch_params(batch))
+            expected = [self.parse_company(company) for company in zeep_reply(OP_COMPANIES, xml) or []]
+            expected = [company_data for company_data in expected if company_data is not None]
+            actual = xmlparser.parse_companies(xml)
+
+            expected_by_bid = {company_data.business_id: company_data for company_data in expected}
+            actual_by_bid = {company_data.business_id: company_data for company_data in actual}
+            for bid in sorted(set(expected_by_bid) | set(actual_by_bid)):
+                if expected_by_bid.get(bid) != actual_by_bid.get(bid):
+                    differences.append((bid, expected_by_bid.get(bid), actual_by_bid.get(bid)))
+
+            if not previous_names:
+                continue
+
+            for company_data in expected:
+                if not self.needs_previous_names(company_data):
+                    continue
+                bid = company_data.business_id
+                timestamp, token = self._get_timestamp_and_token()
+                xml = self._request_raw(OP_PREVIOUS_NAMES, {
+                    "ytunnus": bid,
+                    "asiakastunnus": CUSTOMER_NAME,
+                    "aikaleima": timestamp,
+                    "tarkiste": token,
+                    "tiketti": "",
+                    "kieli": "fi"
+                })
+                response = _serialize(zeep_reply(OP_PREVIOUS_NAMES, xml))
+                expected_names = self._parse_previous_names(response) if response else []
+                actual_names = xmlparser.parse_previous_names(xml)
+                if expected_names != actual_names:
+                    differences.append((bid, expected_names, actual_names))
+
+        return differences
+
+    def get_multiple(self, bids, progbar=None, workers=DEFAULT_WORKERS):
+        """
+        Fetch company data for the given business ids.
+
+        The ids are split into batches of at most MAX_BATCH_SIZE. With workers > 1 up to
+        that many batches are fetched concurrently. The results are always returned in
+        the original batch order.
+        """
+        if not bids:
+            return []
+
+        maxsize = min(MAX_BATCH_SIZE, len(bids))
+        batches = list(_chunked(bids, maxsize))
         bartext = "Reading new company data..."
 
-        for i, batch in enumerate(batches):
-            timestamp, token = self._get_timestamp_and_token()
-            params = {
-                "ytunnus": ";".join(batch),
-                "kieli": "fi",
-                "asiakastunnus": CUSTOMER_NAME,
-                "aikaleima": timestamp,
-                "tarkiste": token,
-                "tiketti": ""
-            }
-            out += self.client.service.wmYritysTiedotMassahaku(**params)
-            progbar.progress((i / len(batches)), f"{bartext} ({i*maxsize} of {len(bids)})")
-        progbar.progress(100, bartext)
+        results = [None] * len(batches)
+        workers = max(1, min(workers, len(batches)))
+
+        # Progress is only updated from the calling thread, Streamlit does not allow
+        # updating the page from the worker threads
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(self._fetch_batch_safe, batch): i for i, batch in enumerate(batches)}
+            done = 0
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                done += 1
+                if progbar is not None:
+                    progbar.progress(done / len(batches), f"{bartext} ({min(done * maxsize, len(bids))} of {len(bids)})")
+
+        if progbar is not None:
+            progbar.progress(100, bartext)
 
+        out = []
+        for result in results:
+            out += result
         return out
 
+    def iter_multiple(self, bids, workers=DEFAULT_WORKERS, batch_size=MAX_BATCH_SIZE):
+        """
+        Lazily fetch company data for an iterable of business ids.
+
+        Yields (batch, companies) tuples in the original order. At most `workers` batches
+        are in flight at a time and new batches are only submitted as the consumer takes
+        results, so memory stays bounded regardless of the number of ids.
+        """
+        batch_size = min(batch_size, MAX_BATCH_SIZE)
+        return self.iter_batches(_chunked(bids, batch_size), workers)
+
+    def iter_batches(self, batches, workers=DEFAULT_WORKERS):
+        """Same as iter_multiple, but for an iterable of already split batches of ids."""
+        batches = iter(batches)
+        workers = max(1, workers)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            in_flight = deque()
+            for batch in islice(batches, workers):
+                in_flight.append((batch, executor.submit(self._fetch_batch_safe, batch)))
+
+            while in_flight:
+                batch, future = in_flight.popleft()
+                companies = future.result()
+                # Refill the window before handing the result to the consumer
+                for next_batch in islice(batches, 1):
+                    in_flight.append((next_batch, executor.submit(self._fetch_batch_safe, next_batch)))
+                yield batch, companies
+
     def search(self, str_="", bid=""):
         timestamp, token = self._get_timestamp_and_token()
         params = {
@@ -134,7 +609,8 @@ class YtjClient:
             "tarkiste": token,
             "tiketti": ""
         }
-        return self.client.service.wmYritysHaku(**params)
+        self._throttle()
+        return self.service.wmYritysHaku(**params)
 
     @staticmethod
     def format_date(date_str):
@@ -269,7 +745,12 @@ class YtjClient:
             return None  # Return None if no registration date is found
 
     def parse_company(self, company, verbose=False):
-        data = helpers.serialize_object(company)
+        # Raw XML fragments come from the fast parser path
+        if isinstance(company, bytes):
+            from ytj_api import xmlparser
+            return xmlparser.parse_company_xml(company)
+
+        data = _serialize(company)
 
         # If data is not a dictionary, or does not have the required key, return None.
         # This prevents the AttributeError from occurring.
@@ -326,20 +807,81 @@ class YtjClient:
         trade_names = self.extract_names(data, 'Aputoiminimet')
         secondary_names = self.extract_names(data, 'Rinnakkaistoiminimet')
 
+        # Previous names are filled in by enrich_previous_names, which is a separate stage
+        # because it needs an extra wmToiminimi call per company
         previous_names = []
-        if format in ['Osakeyhtiö', 'Julkinen osakeyhtiö'] and name != '[tyhjä]':
-            previous_names = self._fetch_previous_names(businessid)
 
         business_id_events = self.extract_business_id_events(data)
 
         if verbose:
             print(f"{businessid}: {name}, {format}, {status}, {businessline}, {zipcode}, {hq}")
 
-        return [businessid, name, format, businessline, zipcode, registration, status, hq,
-                trade_names,
-                secondary_names,
-                previous_names,
-                business_id_events]
+        return CompanyRecord(businessid, name, format, businessline, zipcode, registration, status, hq,
+                             trade_names,
+                             secondary_names,
+                             previous_names,
+                             business_id_events)
+
+    @staticmethod
+    def needs_previous_names(company_data):
+        """Check if the previous names of a parsed company should be fetched."""
+        return company_data.company_form in PREVIOUS_NAME_FORMS and company_data.company != '[tyhjä]'
+
+    def _get_stored_content(self, bids):
+        """Return a {business_id: (company, content_hash)} dict of the given business ids already in the database."""
+        from sqlalchemy.sql import text
+
+        if self.db_client is None:
+            raise RuntimeError("No database client set.")
+
+        # Uses its own connection from the engine pool, so this is safe to call from
+        # a different thread than the one holding the database session
+        stored = {}
+        with self.db_client._engine.connect() as connection:
+            for i in range(0, len(bids), LOOKUP_CHUNK_SIZE):
+                chunk = bids[i:i + LOOKUP_CHUNK_SIZE]
+                params = {f"b{j}": bid for j, bid in enumerate(chunk)}
+                placeholders = ", ".join(f":{key}" for key in params)
+                sql = f"SELECT business_id, company, content_hash FROM companies WHERE business_id IN ({placeholders})"
+                for business_id, company, content_hash in connection.execute(text(sql), params):
+                    stored[business_id] = (company, content_hash)
+        return stored
+
+    def enrich_previous_names(self, companies_data, workers=DEFAULT_WORKERS, skip_unchanged=False,
+                              skip_unchanged_content=False):
+        """
+        Fetch the previous names of parsed companies with wmToiminimi.
+
+        Only companies for which needs_previous_names is true are looked up, with up to
+        `workers` requests running concurrently. With skip_unchanged, companies whose name
+        is the same as the one stored at the last check are skipped, their previous names
+        in the database are left as they are. With skip_unchanged_content, companies whose
+        content fingerprint equals the stored content_hash are skipped: store_company_batch
+        with skip_unchanged only updates their checked date, so their previous names would
+        not be written anyway.
+
+        Returns the number of wmToiminimi requests made.
+        """
+        targets = [data for data in companies_data if data is not None and self.needs_previous_names(data)]
+
+        if (skip_unchanged or skip_unchanged_content) and targets:
+            stored = self._get_stored_content([data.business_id for data in targets])
+            if skip_unchanged:
+                targets = [data for data in targets if stored.get(data.business_id, (None, None))[0] != data.company]
+            if skip_unchanged_content:
+                targets = [data for data in targets
+                           if stored.get(data.business_id, (None, None))[1] != data.fingerprint()]
+
+        if not targets:
+            return 0
+
+        workers = max(1, min(workers, len(targets)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(self._fetch_previous_names, [data.business_id for data in targets])
+            for data, previous_names in zip(targets, results):
+                data.previous_names = previous_names
+
+        return len(targets)
 
     def upsert_company(self, columns, data):
         if self.db_client is None:
@@ -369,15 +911,14 @@ class YtjClient:
                 if 'business_id' not in columns:
                     raise ValueError("`columns` must include 'business_id'.")
 
+                rows = []
                 for data in batch_data:
                     if len(data) != len(columns):
                         raise ValueError("Length of data does not match the number of columns.")
-                    
-                    # Create a dictionary for the upsert method
-                    params = dict(zip(columns, data))
-                    
-                    # Call the generic upsert method from DatabaseClient
-                    db.upsert('companies', 'business_id', params)
+                    rows.append(dict(zip(columns, data)))
+
+                # One set-based upsert per chunk instead of an UPDATE and INSERT per company
+                db.upsert_many('companies', ['business_id'], rows)
 
             except (RuntimeError, ValueError) as e:
                 raise RuntimeError(f"Error upserting company batch: {e}")
@@ -396,6 +937,9 @@ class YtjClient:
                 raise RuntimeError(f"Error getting latest BID: {e}")
 
     def mark_empty_bid(self, bid):
+        from sqlalchemy.sql import text
+        from ytj_api import bidindex
+
         if self.db_client is None:
             raise RuntimeError("No database client set.")
         with self.db_client as db:
@@ -403,99 +947,497 @@ class YtjClient:
                 insert_sql = "INSERT INTO unused_businessids (bid, checked) VALUES (:bid, :checked)"
                 current = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
                 db._session.execute(text(insert_sql), {"bid": bid, "checked": current})
+                if self.bid_index is not None:
+                    self.bid_index.mark(bidindex.EMPTY, [bid])
             except RuntimeError as e:
                 raise RuntimeError(f"Error marking empty BID: {e}")
 
     def bid_checksum(self, bid):
+        from ytj_api import businessid
         bid = str(bid).zfill(7)
-        base = [int(x) for x in list(bid[:7])]
-        mod = sum(np.multiply(base, [7, 9, 10, 5, 8, 4, 2])) % 11
-        if mod == 1:
-            return -1
-        return 0 if mod == 0 else 11 - mod
+        return int(businessid.checksums(int(bid[:7])))
 
     def check_bid(self, bid):
-        bid = str(bid)
-        bid_pattern = r'\d{7}-\d'
-        if not re.match(bid_pattern, bid):
-            return False
-        check = int(bid[-1:])
-        checksum = self.bid_checksum(bid)
-        return checksum == check
-
-    def generate_bids(self, start, count):
+        from ytj_api import businessid
+        return bool(businessid.check_bids([str(bid)])[0])
+
+    def generate_bids(self, start, count, skip_known=True):
+        """
+        Generate `count` valid business ids starting from `start`.
+
+        If a bid index is set and skip_known is true, ids that are already stored, known
+        to be empty or recently checked are left out.
+        """
+        from ytj_api import businessid
+
         start = int(str(start).partition('-')[0])
-        bids = []
-        while count:
-            sbid = str(start).zfill(7)
-            checksum = self.bid_checksum(sbid)
-            start += 1
-            if checksum > -1:
-                fullbid = f"{sbid}-{checksum}"
-                bids.append(fullbid)
-                count -= 1
-        return bids
+        if self.bid_index is None or not skip_known:
+            return businessid.generate_bids(start, count)
 
-    def load_bids_from_file(self, file_name):
         bids = []
-        with open(file_name, 'r', encoding='utf-8') as file:
-            for line in file:
-                bid_pattern = r'(\d{7}-\d)'
-                match = re.search(bid_pattern, line)
-                if match:
-                    bid = match.group(1)
-                    if self.check_bid(bid):
-                        bids.append(bid)
+        for numbers, check_digits in businessid.iter_valid_numbers(start):
+            unknown = ~self.bid_index.known(numbers)
+            numbers, check_digits = numbers[unknown], check_digits[unknown]
+            needed = count - len(bids)
+            bids.extend(businessid.format_bids(numbers[:needed], check_digits[:needed]).tolist())
+            if len(bids) >= count:
+                break
         return bids
 
-    def load_bids_from_string(self, string):
-        bids = []
-        for line in string.split('\n'):
-            bid_pattern = r'(\d{7}-\d)'
-            match = re.search(bid_pattern, line)
-            if match:
-                bid = match.group(1)
-                if self.check_bid(bid):
-                    bids.append(bid)
-        return bids
+    def _stored_bids_bitmap(self):
+        """Bitmap of the ids in the companies table, from the bid index if one is set."""
+        if self.bid_index is not None:
+            from ytj_api import bidindex
+            return self.bid_index.bitmaps[bidindex.STORED]
+        if self.db_client is None:
+            raise RuntimeError("No database client set.")
+        from ytj_api import bidfile
+        return bidfile.stored_bitmap(self.db_client)
+
+    def iter_bids_from_file(self, file, skip_stored=False, scanner=None):
+        """
+        Stream the valid business ids of a file, without duplicates.
+
+        `file` is a file name or a text or binary file object, like a Streamlit upload.
+        The first id of each line is taken. With skip_stored, ids already in the companies
+        table are left out, looked up with one query (or from the bid index if set).
+        """
+        from ytj_api import bidfile
+
+        if scanner is None:
+            scanner = bidfile.BidScanner(self._stored_bids_bitmap() if skip_stored else None)
+        for bids in bidfile.iter_bids(file, scanner=scanner):
+            yield from bids
+
+    def load_bids_from_file(self, file, skip_stored=False):
+        return list(self.iter_bids_from_file(file, skip_stored))
+
+    def load_bids_from_string(self, string, skip_stored=False):
+        return list(self.iter_bids_from_file(io.StringIO(string), skip_stored))
 
     def load_new_companies(self, next_bid, count):
         bids = self.generate_bids(next_bid, count)
         companies = self.get_multiple(bids)
         return companies
 
-    def store_companies_to_db(self, companies, columns, progbar):
+    def iter_parsed(self, batches, workers=DEFAULT_WORKERS, skip_unchanged_names=False, skip_unchanged=False):
+        """
+        Parse fetched batches and attach previous names.
+
+        Takes (batch, companies) tuples, as yielded by iter_multiple, and yields
+        (batch, CompanyBatch) tuples with the parsed companies. See enrich_previous_names
+        for skip_unchanged_names, and its skip_unchanged_content for skip_unchanged.
+        """
+        for batch, companies in batches:
+            records = []
+            with self.metrics.timer("parse", "companies"):
+                for company in companies:
+                    company_data = self.parse_company(company)
+                    if company_data is None:
+                        print(f"Skipping empty or invalid company object: {company}")
+                        continue
+                    records.append(company_data)
+            self.metrics.count("parse", "companies", len(records))
+
+            with self.metrics.timer("enrich", "previous_names"):
+                requests_made = self.enrich_previous_names(records, workers=workers,
+                                                           skip_unchanged=skip_unchanged_names,
+                                                           skip_unchanged_content=skip_unchanged)
+            self.metrics.count("enrich", "previous_names", requests_made)
+            yield batch, CompanyBatch(records)
+
+    def run_pipeline(self, bids, columns=COMPANY_COLUMNS, progbar=None, workers=DEFAULT_WORKERS,
+                     queue_size=DEFAULT_QUEUE_SIZE, skip_unchanged_names=False, bulk=True, skip_unchanged=True,
+                     journal=None, resume_run=None, metrics_path=None, on_batch=None, cancel=None):
+        """
+        Fetch, parse and store companies as a streaming pipeline.
+
+        Fetching and parsing run in background threads and the database writes in the
+        calling thread, so the network and the database are busy at the same time. The
+        stages are connected with bounded queues and only a few batches are held in
+        memory at any time, so `bids` can be a generator over any number of ids.
+
+        With bulk, each batch is written with store_company_batch in one transaction,
+        otherwise company by company. With skip_unchanged (bulk only), companies whose
+        content has not changed since the last check only get their checked date updated,
+        and their previous names are not looked up.
+
+        With a ytj_api.journal.RunJournal, the batches of the run and their progress are
+        recorded, and resume_run continues an earlier run of the journal from its batches
+        that were not stored yet (`bids` is then ignored). Fetched but unstored batches are
+        fetched again on resume, which costs no API calls if a response cache is set. A batch
+        with ids that could not be fetched is not marked stored and the run is left
+        unfinished, so resuming retries those ids.
+
+        Failing requests are retried and split to isolate the bad ids, see _fetch_batch_safe.
+        The summary reports the retries, the splits and the (business id, error) pairs of
+        the ids that could not be fetched.
+
+        Stage timings and counters are collected in self.metrics and added to the summary
+        under "metrics"; with metrics_path they are also written to a JSON file. If the
+        database engine is instrumented (DatabaseClient.instrument), the hottest statements
+        are added under "sql". on_batch
+        is called from the calling thread after each stored batch with the running
+        summary, e.g. to update a live view.
+
+        cancel is an optional threading.Event. When it is set, the run stops after the
+        batch being stored, with "cancelled" set in the summary. A journaled run is then
+        left unfinished, so it can be resumed later.
+
+        Returns a summary dict of the run.
+        """
         if self.db_client is None:
             raise RuntimeError("No database client set.")
+        if resume_run is not None and journal is None:
+            raise RuntimeError("No journal set for resuming a run.")
+
+        run_id = None
+        if journal is not None:
+            if resume_run is None:
+                run_id = journal.start_run(_chunked(bids, MAX_BATCH_SIZE))
+            else:
+                run_id = resume_run
+            total = journal.unfinished_count(run_id)
+            # The sequence numbers of the batches in flight, one queue per journaled stage
+            seq_queues = {runjournal.FETCHED: deque(), runjournal.PARSED: deque(), runjournal.STORED: deque()}
+
+            def journal_batches():
+                # The batches are read from the journal as the fetch stage needs them
+                for seq, batch in journal.iter_unfinished_batches(run_id):
+                    for seqs in seq_queues.values():
+                        seqs.append(seq)
+                    yield batch
+
+            batches = journal_batches()
+        else:
+            total = len(bids) if hasattr(bids, '__len__') else None
+            batches = _chunked(bids, MAX_BATCH_SIZE)
+
+        summary = {"bids": 0, "batches": 0, "companies": 0, "changed": 0, "unchanged": 0, "last_bid": None,
+                   "run_id": run_id, "cancelled": False, "unstored_batches": 0}
+        self.fetch_stats = FetchStats()
+        self.metrics = PipelineMetrics()
+        bartext = "Reading and saving companies..."
+
+        def journaled(stage, state):
+            # The stages keep the batch order, so the batches line up with their sequence numbers
+            for item in stage:
+                journal.mark(run_id, seq_queues[state].popleft(), state)
+                yield item
+
+        fetched = self.iter_batches(batches, workers=workers)
+        if journal is not None:
+            fetched = journaled(fetched, runjournal.FETCHED)
+        # Unchanged companies are only skipped when storing in bulk, so only then are their lookups saved
+        parsed = self.iter_parsed(fetched, workers=workers, skip_unchanged_names=skip_unchanged_names,
+                                  skip_unchanged=bulk and skip_unchanged)
+        if journal is not None:
+            parsed = journaled(parsed, runjournal.PARSED)
+        parsed = _prefetch(parsed, queue_size)
+
+        # parsed is closed however the loop ends, which stops the fetch and parse threads
+        with self.db_client as db, closing(parsed):
+            for batch, company_batch in parsed:
+                # The ids that could not be fetched are neither stored nor known to be empty
+                failed = {bid for bid, _ in self.fetch_stats.failed_bids}
+                checked = [bid for bid in batch if bid not in failed]
+                if bulk:
+                    changed, unchanged = self.store_company_batch(db, company_batch, columns, skip_unchanged,
+                                                                  checked_bids=checked)
+                    summary["changed"] += changed
+                    summary["unchanged"] += unchanged
+                else:
+                    # One transaction per batch, like in bulk mode
+                    self.store_companies_by_one(db, company_batch, columns, checked_bids=checked)
+                    db._session.commit()
+                    summary["changed"] += len(company_batch)
+
+                if self.bid_index is not None:
+                    from ytj_api import bidindex
+                    self.bid_index.mark(bidindex.CHECKED, checked)
+                    self.bid_index.mark(bidindex.STORED, company_batch.business_id)
+                    self.bid_index.mark(bidindex.EMPTY, sorted(set(checked) - set(company_batch.business_id)))
+
+                if journal is not None:
+                    # The batch is committed by now. A batch with ids that could not be fetched
+                    # is left unstored, so resuming the run fetches it again.
+                    seq = seq_queues[runjournal.STORED].popleft()
+                    if len(checked) == len(batch):
+                        journal.mark(run_id, seq, runjournal.STORED)
+                    else:
+                        summary["unstored_batches"] += 1
+
+                summary["bids"] += len(batch)
+                summary["batches"] += 1
+                summary["companies"] += len(company_batch)
+                summary["last_bid"] = batch[-1]
+
+                if progbar is not None:
+                    if total:
+                        progbar.progress(min(summary["bids"] / total, 1.0),
+                                         f"{bartext} ({summary['bids']} of {total})")
+                    else:
+                        progbar.progress(0, f"{bartext} ({summary['bids']})")
+
+                if on_batch is not None:
+                    on_batch(summary)
+
+                if cancel is not None and cancel.is_set():
+                    # The batches in flight are dropped
+                    summary["cancelled"] = True
+                    break
+
+        if journal is not None and not summary["cancelled"] and not summary["unstored_batches"]:
+            journal.finish_run(run_id)
+
+        summary["retries"] = self.fetch_stats.retries
+        summary["splits"] = self.fetch_stats.splits
+        summary["failed_bids"] = list(self.fetch_stats.failed_bids)
+        sql_stats = self.db_client.sql_stats
+        if sql_stats is not None:
+            # Totals of the engine since it was instrumented, not only of this run
+            summary["sql"] = sql_stats.report(top=SQL_REPORT_TOP)
+        if metrics_path is not None:
+            self.metrics.save(metrics_path, summary=summary)
+        summary["metrics"] = self.metrics.summary()
+
+        if progbar is not None:
+            progbar.progress(100, bartext)
+
+        return summary
+
+    def store_companies_to_db(self, companies, columns, progbar=None, workers=DEFAULT_WORKERS,
+                              skip_unchanged_names=False, bulk=True, skip_unchanged=True):
+        """
+        Parse and store already fetched companies. See run_pipeline for the options.
+
+        Returns a summary dict with the changed and unchanged company counts.
+        """
+        if self.db_client is None:
+            raise RuntimeError("No database client set.")
+
+        companies_data = []
+        for company in companies:
+            company_data = self.parse_company(company)
+            if company_data is None:
+                print(f"Skipping empty or invalid company object: {company}")
+                continue
+            companies_data.append(company_data)
+
+        if progbar is not None:
+            progbar.progress(0, "Reading previous company names...")
+        self.enrich_previous_names(companies_data, workers=workers, skip_unchanged=skip_unchanged_names,
+                                   skip_unchanged_content=bulk and skip_unchanged)
 
         with self.db_client as db:
             bartext = "Saving companies to the database..."
-            progbar.progress(0, bartext)
+            if progbar is not None:
+                progbar.progress(0, bartext)
 
-            for i, company in enumerate(companies):
-                company_data = self.parse_company(company)
-                if company_data is None:
-                    print(f"Skipping empty or invalid company object: {company}")
-                    continue
+            summary = {"companies": len(companies_data), "changed": 0, "unchanged": 0}
 
-                self._store_core_data(db, columns, company_data)
-                self._store_names_data(db, company_data, "trade_names", TRADE_NAMES, "trade_name")
-                self._store_names_data(db, company_data, "secondary_names", SECONDARY_NAMES, "secondary_name")
-                self._store_names_data(db, company_data, "previous_names", PREVIOUS_NAMES, "previous_name")
-                self._store_business_id_events(db, company_data)
+            # In bulk mode the companies are stored a batch at a time, else one by one
+            step = MAX_BATCH_SIZE if bulk else 1
+            for i in range(0, len(companies_data), step):
+                if bulk:
+                    changed, unchanged = self.store_company_batch(
+                        db, CompanyBatch(companies_data[i:i + step]), columns, skip_unchanged)
+                    summary["changed"] += changed
+                    summary["unchanged"] += unchanged
+                else:
+                    self.store_companies_by_one(db, CompanyBatch(companies_data[i:i + step]), columns)
+                    summary["changed"] += 1
 
-                progbar.progress((i / len(companies)), f"{bartext} ({i} of {len(companies)})")
+                if progbar is not None:
+                    progbar.progress((i / len(companies_data)), f"{bartext} ({i} of {len(companies_data)})")
 
-            progbar.progress(100, bartext)
+            if progbar is not None:
+                progbar.progress(100, bartext)
+
+        return summary
+
+    def store_company_batch(self, db, company_batch, columns=COMPANY_COLUMNS, skip_unchanged=True,
+                            checked_bids=None):
+        """
+        Store a CompanyBatch with set-based statements in one transaction.
+
+        The companies are upserted with one MERGE (MSSQL) or INSERT ... ON CONFLICT
+        (Postgres) and the names and business id events of the companies that have them
+        are replaced with one DELETE and multi-row INSERTs per table. Same result as
+        storing the companies one by one with _store_company.
+
+        With skip_unchanged, companies whose content fingerprint equals the content_hash
+        stored at the last check only get their checked date updated.
+
+        With update_stats, the db_api.stats counts of companies by status and of names,
+        and the last business id and registration date, are updated in the same
+        transaction from the differences to the stored rows.
+
+        checked_bids are the ids the batch was fetched for. Those without a company in
+        the batch are recorded in unused_businessids in the same transaction.
+
+        Returns a (changed, unchanged) tuple of company counts.
+        """
+        if not len(company_batch) and not checked_bids:
+            return 0, 0
+
+        # A company repeated in the batch is stored once, from its last record
+        company_batch = company_batch.latest()
+        checked = datetime.today().strftime('%Y-%m-%d')
+        fingerprints = company_batch.fingerprints()
+        fetched_bids = company_batch.business_id
+        try:
+            unchanged = []
+            stored = {}
+            if skip_unchanged or self.update_stats:
+                with self.metrics.timer("db", "companies"):
+                    stored = {bid: (content_hash, status) for bid, content_hash, status in
+                              db.select_in('companies', ['business_id', 'content_hash', 'status'], 'business_id',
+                                           company_batch.business_id)}
+            if skip_unchanged:
+                unchanged = [i for i, (bid, fingerprint) in enumerate(zip(company_batch.business_id, fingerprints))
+                             if bid in stored and stored[bid][0] == fingerprint]
+                with self.metrics.timer("db", "companies"):
+                    db.update_many('companies', {'checked': checked}, 'business_id',
+                                   [company_batch.business_id[i] for i in unchanged])
+
+                if unchanged:
+                    changed = sorted(set(range(len(company_batch))) - set(unchanged))
+                    fingerprints = [fingerprints[i] for i in changed]
+                    company_batch = company_batch.subset(changed)
+
+            # The parameters are bound straight from the columns of the batch
+            data = company_batch.core_columns(columns, checked)
+            data['content_hash'] = fingerprints
+            with self.metrics.timer("db", "companies"):
+                db._bulk_upsert_columns('companies', 'business_id', data)
+            self.metrics.count("db_rows", "companies", len(company_batch))
+
+            deltas = self._company_deltas(company_batch, {bid: status for bid, (_, status) in stored.items()})
+
+            for table_name, field, name_field in NAME_TABLES:
+                names = getattr(company_batch, field)
+                replaced = [bid for bid, company_names in zip(company_batch.business_id, names) if company_names]
+                name_data = company_batch.name_columns(field, name_field)
+                inserted = len(name_data['business_id'])
+                with self.metrics.timer("db", table_name):
+                    deleted = db.delete_many(table_name, 'business_id', replaced)
+                    db.insert_columns(table_name, name_data)
+                self.metrics.count("db_rows", table_name, inserted)
+                deltas[table_name] = inserted - deleted
+
+            replaced = [bid for bid, events in zip(company_batch.business_id, company_batch.business_id_events) if events]
+            event_data = company_batch.event_columns()
+            with self.metrics.timer("db", "business_id_events"):
+                db.delete_many('business_id_events', 'business_id_new', replaced)
+                db.insert_columns('business_id_events', event_data)
+            self.metrics.count("db_rows", "business_id_events", len(event_data['business_id_old']))
+
+            if checked_bids:
+                self._store_empty_bids(db, checked_bids, fetched_bids)
+
+            if self.update_stats:
+                self._update_stats(db, company_batch, deltas)
+
+            with self.metrics.timer("db", "commit"):
+                db._session.commit()
+        except Exception as e:
+            db._session.rollback()
+            raise RuntimeError(f"Error storing company batch: {e}")
+
+        return len(company_batch), len(unchanged)
+
+    def store_companies_by_one(self, db, company_batch, columns=COMPANY_COLUMNS, checked_bids=None):
+        """
+        Store a CompanyBatch company by company with _store_company, without committing.
+
+        The slow path of run_pipeline with bulk=False. Updates the same statistics and
+        unused_businessids rows as store_company_batch.
+        """
+        company_batch = company_batch.latest()
+        stored = {}
+        names_deleted = {}
+        if self.update_stats:
+            with self.metrics.timer("db", "companies"):
+                stored = dict(db.select_in('companies', ['business_id', 'status'], 'business_id',
+                                           company_batch.business_id))
+            for table_name, field, _ in NAME_TABLES:
+                replaced = [bid for bid, names in zip(company_batch.business_id, getattr(company_batch, field))
+                            if names]
+                names_deleted[table_name] = len(db.select_in(table_name, ['business_id'], 'business_id', replaced))
+
+        for company_data in company_batch:
+            self._store_company(db, columns, company_data)
+        if checked_bids:
+            self._store_empty_bids(db, checked_bids, company_batch.business_id)
+
+        if self.update_stats:
+            deltas = self._company_deltas(company_batch, stored)
+            for table_name, field, _ in NAME_TABLES:
+                inserted = sum(len(names) for names in getattr(company_batch, field) if names)
+                deltas[table_name] = inserted - names_deleted[table_name]
+            self._update_stats(db, company_batch, deltas)
+
+    @staticmethod
+    def _company_deltas(company_batch, stored_status):
+        """Return the company count deltas by status of storing a batch, from the {bid: status} stored before."""
+        deltas = {}
+        # A business id repeated in the batch is counted once, with the status of its last record
+        latest = dict(zip(company_batch.business_id, company_batch.status))
+        for bid, status in latest.items():
+            if bid not in stored_status:
+                deltas["companies"] = deltas.get("companies", 0) + 1
+            elif stored_status[bid] == status:
+                continue
+            else:
+                old_key = db_stats.status_key(stored_status[bid])
+                deltas[old_key] = deltas.get(old_key, 0) - 1
+            new_key = db_stats.status_key(status)
+            deltas[new_key] = deltas.get(new_key, 0) + 1
+        return deltas
+
+    def _update_stats(self, db, company_batch, deltas):
+        with self.metrics.timer("db", "stats"):
+            db_stats.add(db, deltas)
+            db_stats.set_max(db, {
+                "last_bid": max((bid for bid in company_batch.business_id
+                                 if bid < db_stats.LAST_BID_LIMIT), default=None),
+                "latest_registration_date": max(filter(None, company_batch.company_registration_date),
+                                                default=None)})
+
+    def _store_empty_bids(self, db, bids, stored_bids):
+        """
+        Record the ids of `bids` that are not in `stored_bids` in unused_businessids.
+
+        The rows of all the given ids are replaced, so an id that has got a company since
+        its last check is removed. Runs in the current transaction and does not commit.
+        """
+        stored_bids = set(stored_bids)
+        rows = [{"bid": bid, "checked": datetime.today().strftime('%Y-%m-%d')}
+                for bid in bids if bid not in stored_bids]
+        with self.metrics.timer("db", "unused_businessids"):
+            db.delete_many('unused_businessids', 'bid', bids)
+            db.insert_many('unused_businessids', rows)
+        self.metrics.count("db_rows", "unused_businessids", len(rows))
+
+    def _store_company(self, db, columns, company_data):
+        with self.metrics.timer("db", "companies"):
+            self._store_core_data(db, columns, company_data)
+        for table_name, field, name_field in NAME_TABLES:
+            with self.metrics.timer("db", table_name):
+                self._store_names_data(db, company_data, table_name, field, name_field)
+        with self.metrics.timer("db", "business_id_events"):
+            self._store_business_id_events(db, company_data)
 
     def _store_core_data(self, db, columns, company_data):
-        core_data = company_data[:8]
+        core_data = company_data.core_values()
         core_data.append(datetime.today().strftime('%Y-%m-%d'))
-        self.upsert_company(columns, core_data)
+        core_data.append(company_data.fingerprint())
+        self.upsert_company(list(columns) + ['content_hash'], core_data)
 
-    def _store_names_data(self, db, company_data, table_name, data_index, name_field):
-        business_id = company_data[BUSINESS_ID]
-        names = company_data[data_index]
+    def _store_names_data(self, db, company_data, table_name, field, name_field):
+        business_id = company_data.business_id
+        names = getattr(company_data, field)
         if names:
             db.delete(table_name, "business_id", business_id)
             for name in names:
@@ -507,8 +1449,8 @@ class YtjClient:
                 })
 
     def _store_business_id_events(self, db, company_data):
-        business_id = company_data[BUSINESS_ID]
-        events = company_data[EVENTS]
+        business_id = company_data.business_id
+        events = company_data.business_id_events
         if events:
             db.delete("business_id_events", "business_id_new", business_id)
             for event in events: